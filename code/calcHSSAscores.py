@@ -14,6 +14,7 @@ import sqlite3
 import code
 import logging
 import generalDBFunctions as db_fns
+import hssa_engine
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -22,15 +23,26 @@ db_fn =  '../query_results/sea_5km.db'
 max_dur = 30*60 # 30 minutes
 dem_col_name = 'pop_over_65'
 
-def main(db_fn, dem_col_name, max_dur):
+def main(db_fn, dem_col_name, max_dur, engine='loop', processes=1):
     '''
     calculate the walk score for each origin, and the funding allocated to each origin (investment)
     dem_col_name is the column name in the database of the demographic to be used for the investment calculations
+    engine is 'loop' (origin by origin) or 'vectorized' (every origin at once, see hssa_engine),
+    which give the same scores. The vectorized engine scores the origins with processes
+    worker processes if more than one.
     '''
     logger.info('calculating HSSA scores')
     db = sqlite3.connect(db_fn)
     cursor = db.cursor()
 
+    if engine == 'vectorized':
+        scores_pd = hssa_engine.scoreCity(db, dem_col_name, max_dur, processes)
+        logger.info('...normalized the scores')
+        WriteDB(scores_pd, db, 'investment')
+        WriteDB(scores_pd, db, 'HSSAscore')
+        db.commit()
+        return
+
     # get pd.DataFrame of orig ids and population of interest
     c_names = db_fns.getColNames(db, 'orig')
     dem_c_id = np.where(np.array(c_names) == dem_col_name)[0][0]
@@ -94,6 +106,23 @@ def main(db_fn, dem_col_name, max_dur):
     db.commit()
 
 
+def sweep(db_fn, dem_col_name, max_durs, check=False):
+    '''
+    calculate the walk score and investment of each origin for each of several maximum walking
+    durations (e.g. [10*60, 20*60, 30*60, 45*60]) in one pass (see hssa_engine.sweepCity),
+    and add them side by side to the orig table as HSSAscore_<max_dur> and investment_<max_dur>
+    if check, first check them against scoring each max_dur on its own (see hssa_engine.checkSweep)
+    '''
+    logger.info('calculating HSSA scores for max_durs {}'.format(max_durs))
+    db = sqlite3.connect(db_fn)
+    scores_pd = hssa_engine.sweepCity(db, dem_col_name, max_durs)
+    if check:
+        hssa_engine.checkSweep(db, dem_col_name, scores_pd)
+    for col_name in scores_pd.columns[1:]:
+        WriteDB(scores_pd, db, col_name)
+    db.commit()
+
+
 def normalizeContractData(cursor):
     '''
     Fetch the contracts data
@@ -246,11 +275,15 @@ def WriteDB(df, db, col_name):
     add_col_str = "ALTER TABLE orig ADD COLUMN {} REAL".format(col_name)
     db.execute(add_col_str) 
 
-    for i in range(len(df)):
-        add_data_str = "UPDATE orig SET {} =(?) WHERE orig_id=(?)".format(col_name)
-        value = df.iloc[i][col_name]
-        idx = df.iloc[i]['orig_id']
-        db.execute(add_data_str, (value, idx))
+    # set the column from a keyed temporary table, in one pass over orig
+    db.execute('DROP TABLE IF EXISTS temp.new_values')
+    db.execute('CREATE TEMP TABLE new_values(orig_id VARCHAR (15) PRIMARY KEY, value REAL)')
+    db.executemany('INSERT OR REPLACE INTO temp.new_values(orig_id, value) VALUES(?, ?)',
+        zip(df['orig_id'], df[col_name].astype(float)))
+    add_data_str = '''UPDATE orig SET {} = (SELECT value FROM temp.new_values
+        WHERE new_values.orig_id = orig.orig_id)'''.format(col_name)
+    db.execute(add_data_str)
+    db.execute('DROP TABLE temp.new_values')
 
     db.commit()
 
@@ -0,0 +1,417 @@
+'''
+Vectorized HSSA scoring: the same HSSA scores and investments as the per-origin loop of
+calcHSSAscores, for the whole city at once.
+destsubset and contracts are read once, and the per-origin steps (the closest service of each
+contract, the variety weights, the distance decay and the budget weighting) are grouped array
+operations. Rows are kept in the order the loop visits them and the sums are accumulated in the
+same order, so the results are identical.
+The origins can be scored in parallel, by a pool of processes which read the pairs and
+contracts from memory-mapped files (see scoreParallel).
+'''
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import generalDBFunctions as db_fns
+logger = logging.getLogger(__name__)
+
+# the variety weights of the services of an origin, in the order they are visited
+# (calcHSSAScore pops them from one list for every category); any further service gets 0
+VARIETY_WEIGHTS = np.array([1, .75, .5, .25, .1])
+# the starting minimum of getMinContractDists: services this far away are never the closest
+NO_DURATION = 99999
+# chunks of origins per process when scoring in parallel, so that uneven chunks even out
+CHUNKS_PER_PROCESS = 4
+
+
+def scoreCity(db, dem_col_name, max_dur, processes=1):
+    '''
+    Calculate the HSSA score and investment of every origin, as calcHSSAscores.main does,
+    with processes worker processes if more than one (see scoreParallel).
+    Returns a pd.DataFrame of orig_id, HSSAscore (normalized to 100) and investment.
+    '''
+    orig_ids, pop = loadOrigins(db, dem_col_name)
+    pairs, dest_ids = loadPairs(db, orig_ids)
+    return scorePairs(db, orig_ids, pop, pairs, dest_ids, max_dur, processes)
+
+
+def scorePairs(db, orig_ids, pop, pairs, dest_ids, max_dur, processes=1):
+    '''
+    scoreCity for the pairs (see pairArrays) in place of destsubset
+    '''
+    contracts, amounts = loadContracts(db, dest_ids)
+    logger.info('Scoring {} origins with {} O-D pairs and {} contracts'.format(len(orig_ids), len(pairs['orig']),
+        len(amounts)))
+
+    if processes > 1:
+        scores, ppl, reach = scoreParallel(pairs, contracts, pop, max_dur, len(amounts), processes)
+    else:
+        scores, ppl, reach = scoreOrigins(pairs, contracts, pop, max_dur, len(amounts), 0, len(pop))
+    investment = fundOrigins(reach, perCapita(amounts, ppl), pop)
+
+    scores_pd = pd.DataFrame({'orig_id' : orig_ids, 'HSSAscore' : scores, 'investment' : investment})
+    scores_pd['HSSAscore'] = 100 * scores_pd['HSSAscore'].divide(max(scores_pd['HSSAscore']))
+    return scores_pd
+
+
+def sweepCity(db, dem_col_name, max_durs):
+    '''
+    The HSSA score and investment of every origin for each of several max_durs (whole seconds),
+    each as scoreCity gives them on a destsubset made for that max_dur (see subset_database).
+    Every row of the largest walkshed is read from the walking table (or from destsubset, which
+    then limits every walkshed, if there is no walking table) and joined to the contracts once;
+    each walkshed then takes the first row of each pair within its max_dur.
+    Returns a pd.DataFrame of orig_id and, side by side, HSSAscore_<max_dur> (normalized to 100)
+    and investment_<max_dur> for each max_dur.
+    '''
+    max_durs = sorted(set(max_durs))
+    orig_ids, pop = loadOrigins(db, dem_col_name)
+    if 'walking' not in db_fns.getTabNames(db):
+        logger.warning('No walking table: the walksheds are limited to the pairs in destsubset')
+    pairs, dest_ids = loadWalkshed(db, orig_ids, max_durs[-1], first=False)
+    contracts, amounts = loadContracts(db, dest_ids)
+    services = joinServices(pairs, contracts)
+    logger.info('Sweeping {} max_durs over {} origins with {} services'.format(len(max_durs), len(orig_ids),
+        len(services['orig'])))
+
+    ordered, visit = sweepGroups(services)
+    scores_pd = pd.DataFrame({'orig_id' : orig_ids})
+    for max_dur in max_durs:
+        # the services of the first row of each pair within max_dur
+        in_walkshed = np.flatnonzero((ordered['walking_time'] < max_dur) & (ordered['until'] >= max_dur))
+        starts = np.flatnonzero(rankInGroup(ordered['group'][in_walkshed]) == 0)
+        # the first service of each group in the walkshed is the closest
+        closest = np.zeros(len(ordered['group']), dtype=bool)
+        closest[in_walkshed[starts]] = True
+        closest &= ordered['walking_time'] < NO_DURATION
+        scores = calcScores(take(ordered, visit[closest[visit]]), max_dur, len(pop))
+        first_row = np.minimum.reduceat(ordered['contract_row'][in_walkshed], starts) if len(starts) else starts
+        reach = sweepReach(take(ordered, in_walkshed[starts]), first_row, len(pop), len(amounts))
+        scores_pd['HSSAscore_{}'.format(max_dur)] = 100 * pd.Series(scores).divide(max(scores)).values
+        scores_pd['investment_{}'.format(max_dur)] = fundOrigins(reach, perCapita(amounts, reach.T @ pop), pop)
+    return scores_pd
+
+
+def checkSweep(db, dem_col_name, scores_pd):
+    '''
+    Check the scores of sweepCity against scoring each of its max_durs on its own, as scoreCity
+    does on a destsubset made for it. Raises ValueError for the max_durs whose HSSA scores or
+    investments differ.
+    '''
+    orig_ids, pop = loadOrigins(db, dem_col_name)
+    max_durs = [int(col_name.split('_')[-1]) for col_name in scores_pd.columns if col_name.startswith('HSSAscore_')]
+    differ = []
+    for max_dur in max_durs:
+        pairs, dest_ids = loadWalkshed(db, orig_ids, max_dur)
+        ref = scorePairs(db, orig_ids, pop, pairs, dest_ids, max_dur)
+        if not (np.array_equal(ref.HSSAscore.values, scores_pd['HSSAscore_{}'.format(max_dur)].values, equal_nan=True)
+                and np.array_equal(ref.investment.values, scores_pd['investment_{}'.format(max_dur)].values)):
+            differ.append(max_dur)
+    if differ:
+        raise ValueError('The sweep differs from scoring each walkshed on its own for max_durs {}'.format(differ))
+    logger.info('Checked the sweep for max_durs {}'.format(max_durs))
+
+
+def sweepGroups(services):
+    '''
+    The services sorted by origin and contract (a group), then walking time and contract row,
+    so that the first service of a group within a walkshed is its closest, with their group.
+    Also returns the order the loop visits the services in (by origin, then contract row).
+    '''
+    ordered = take(services, np.lexsort((services['contract_row'], services['walking_time'],
+        services['contract'], services['orig'])))
+    first = np.ones(len(ordered['orig']), dtype=bool)
+    first[1:] = (np.diff(ordered['orig']) != 0) | (np.diff(ordered['contract']) != 0)
+    ordered['group'] = np.cumsum(first) - 1
+    return ordered, np.lexsort((ordered['contract_row'], ordered['orig']))
+
+
+def sweepReach(groups, first_row, n_origs, n_contracts):
+    '''
+    The reachMatrix of the groups in a walkshed, given the lowest contract row of the services
+    of each in it (first_row): the contracts of each origin in the order they are first found
+    '''
+    order = np.lexsort((first_row, groups['orig']))
+    indptr = np.r_[0, np.cumsum(np.bincount(groups['orig'], minlength=n_origs))]
+    return sp.csr_matrix((np.ones(len(order)), groups['contract'][order], indptr), shape=(n_origs, n_contracts))
+
+
+def loadOrigins(db, dem_col_name):
+    '''
+    The orig_ids and the population (dem_col_name) of each as floats
+    '''
+    cursor = db.cursor()
+    origs = db_fns.getTable(cursor, 'orig', [0, getColumn(cursor, 'orig', dem_col_name)], ['orig_id', 'pop'])
+    return origs.orig_id, origs['pop'].values.astype(float)
+
+
+def getColumn(cursor, table_name, col_name):
+    '''
+    The number of a column of a table
+    '''
+    return db_fns.getColNames(cursor, table_name).index(col_name)
+
+
+def loadPairs(db, orig_ids):
+    '''
+    Read the destsubset pairs as arrays (see pairArrays)
+    '''
+    return pairArrays(pd.read_sql_query('SELECT orig_id, dest_id, walking_time FROM destsubset', db), orig_ids)
+
+
+def loadWalkshed(db, orig_ids, max_dur, first=True):
+    '''
+    Read the pairs destsubset would hold for max_dur (see subset_database) from the walking
+    table, or from destsubset if there is none, as arrays (see pairArrays)
+    '''
+    if 'walking' in db_fns.getTabNames(db):
+        query_str = '''SELECT orig_id, dest_id, duration AS walking_time FROM walking
+            WHERE duration < ? AND dest_id IN (SELECT dest_id FROM contracts)'''
+    else:
+        query_str = 'SELECT orig_id, dest_id, walking_time FROM destsubset WHERE walking_time < ?'
+    pairs = pd.read_sql_query(query_str, db, params=(max_dur,))
+    # destsubset keeps the walking times as whole seconds
+    pairs['walking_time'] = pairs.walking_time.astype(int)
+    return pairArrays(pairs, orig_ids, first)
+
+
+def pairArrays(pairs, orig_ids, first=True):
+    '''
+    O-D pairs (a pd.DataFrame of orig_id, dest_id and walking_time) as arrays: the position of
+    the origin in orig_ids (orig), the destination as a code (dest) and the walking_time of the
+    first row of each pair, as getMinContractDists reads it. With first=False, every row is
+    kept, with the lowest walking_time of the earlier rows of its pair (until, inf for the
+    first): a row is the first of its pair within max_dur if walking_time < max_dur <= until.
+    The pairs are sorted by origin. Returns the arrays and the dest_ids of the codes.
+    '''
+    orig = pd.Index(orig_ids).get_indexer(pairs.orig_id)
+    dest, dest_ids = pd.factorize(pairs.dest_id)
+    pair = orig.astype(np.int64) * len(dest_ids) + dest
+    if first:
+        # the first row of each pair
+        keep = np.zeros(len(pairs), dtype=bool)
+        keep[np.unique(pair, return_index=True)[1]] = True
+    else:
+        keep = np.ones(len(pairs), dtype=bool)
+    keep &= orig >= 0
+    order = np.flatnonzero(keep)[np.argsort(orig[keep], kind='stable')]
+    arrays = {'orig' : orig[order].astype(np.int64), 'dest' : dest[order].astype(np.int64),
+        'walking_time' : pairs.walking_time.values[order].astype(float)}
+    if not first:
+        earlier = pd.Series(pairs.walking_time.values.astype(float)).groupby(pair).shift()
+        arrays['until'] = earlier.groupby(pair).cummin().fillna(np.inf).values[order]
+    return arrays, dest_ids
+
+
+def loadContracts(db, dest_ids):
+    '''
+    Read the contracts table in row order, as contractArrays
+    '''
+    return contractArrays(pd.read_sql_query('SELECT * FROM contracts', db), dest_ids)
+
+
+def contractArrays(contracts, dest_ids):
+    '''
+    The rows of a contracts pd.DataFrame as arrays: the destination as a code of dest_ids
+    (dest), the row number (contract_row), the ContractNo as a code (contract) and the
+    TotalBudgt (budget) of the rows at one of the dest_ids, with identical rows once,
+    as getVendorsForOrig finds them. Also returns the total TotalBudgt of each ContractNo,
+    added in row order as normalizeContractData does.
+    '''
+    contract = pd.factorize(contracts.ContractNo, use_na_sentinel=False)[0]
+    amounts = np.bincount(contract, weights=contracts.TotalBudgt.values.astype(float))
+
+    dest = pd.Index(dest_ids).get_indexer(contracts.dest_id)
+    keep = (~contracts.duplicated()).values & (dest >= 0)
+    arrays = {'dest' : dest[keep].astype(np.int64), 'contract_row' : np.flatnonzero(keep),
+        'contract' : contract[keep].astype(np.int64), 'budget' : contracts.TotalBudgt.values[keep].astype(float)}
+    return arrays, amounts
+
+
+def scoreOrigins(pairs, contracts, pop, max_dur, n_contracts, start, stop):
+    '''
+    Score the origins start to stop (positions): their unnormalized HSSA scores, the people
+    they add to each contract (the contract populations of these origins) and their rows of
+    the reachMatrix
+    '''
+    lo, hi = np.searchsorted(pairs['orig'], [start, stop])
+    chunk = {name : array[lo:hi] for name, array in pairs.items()}
+    chunk['orig'] = chunk['orig'] - start
+    services = joinServices(chunk, contracts)
+    scores = calcScores(closestServices(services), max_dur, stop - start)
+    reach = reachMatrix(services, stop - start, n_contracts)
+    ppl = reach.T @ pop[start:stop]
+    return scores, ppl, reach
+
+
+def joinServices(pairs, contracts):
+    '''
+    The services in reach of each origin: the pairs joined to the contract rows at their
+    destination, sorted by origin and then contract row, the order the loop visits them in
+    '''
+    by_dest = np.lexsort((contracts['contract_row'], contracts['dest']))
+    counts = np.bincount(contracts['dest'], minlength=pairs['dest'].max() + 1 if len(pairs['dest']) else 0)
+    firsts = np.cumsum(counts) - counts
+
+    n_services = counts[pairs['dest']]
+    pair = np.repeat(np.arange(len(n_services)), n_services)
+    within = np.arange(len(pair)) - np.repeat(np.cumsum(n_services) - n_services, n_services)
+    row = by_dest[firsts[pairs['dest']][pair] + within]
+
+    services = {name : array[pair] for name, array in pairs.items() if name != 'dest'}
+    services.update({name : contracts[name][row] for name in ['contract_row', 'contract', 'budget']})
+    return take(services, np.lexsort((services['contract_row'], services['orig'])))
+
+
+def closestServices(services):
+    '''
+    The closest service of each contract for each origin (the first of them if several are
+    as close), in the order the loop visits them, as getMinContractDists keeps them
+    '''
+    services = take(services, services['walking_time'] < NO_DURATION)
+    ordered = take(services, np.lexsort((services['contract_row'], services['walking_time'],
+        services['contract'], services['orig'])))
+    first = np.ones(len(ordered['orig']), dtype=bool)
+    first[1:] = (np.diff(ordered['orig']) != 0) | (np.diff(ordered['contract']) != 0)
+    closest = take(ordered, first)
+    return take(closest, np.lexsort((closest['contract_row'], closest['orig'])))
+
+
+def calcScores(closest, max_dur, n_origs):
+    '''
+    The (unnormalized) HSSA score of each origin from its closest services, as calcHSSAScore:
+    the sum of variety weight x distance weight x TotalBudgt, in visiting order
+    '''
+    rank = rankInGroup(closest['orig'])
+    variety_weight = np.zeros(len(rank))
+    visited = rank < len(VARIETY_WEIGHTS)
+    variety_weight[visited] = VARIETY_WEIGHTS[rank[visited]]
+    distance_weight = linearDecay(closest['walking_time'], max_dur)
+    terms = variety_weight * distance_weight * closest['budget']
+    # bincount adds the terms of each origin one by one, in order, as the loop does
+    return np.bincount(closest['orig'], weights=terms, minlength=n_origs)
+
+
+def reachMatrix(services, n_origs, n_contracts):
+    '''
+    The sparse (CSR) origin x contract reachability matrix: 1 for each contract in reach of an
+    origin. The contracts of each row are kept in the order they are first found (see
+    origContracts), which is the order calcOrigFunding adds them in.
+    '''
+    reach = origContracts(services)
+    indptr = np.r_[0, np.cumsum(np.bincount(reach['orig'], minlength=n_origs))]
+    return sp.csr_matrix((np.ones(len(reach['orig'])), reach['contract'], indptr), shape=(n_origs, n_contracts))
+
+
+def perCapita(amounts, ppl):
+    '''
+    The spending per person of each contract (calcPerCapSpending): its total amount shared
+    between the people served by it (ppl), 0 if it serves no one
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(ppl > 0, amounts / ppl, 0)
+
+
+def fundOrigins(reach, per_cap, pop):
+    '''
+    The investment of each origin (calcOrigFunding): the per capita spending of each contract
+    it reaches times its population. With the population of each origin in place of its 1s
+    in the reachMatrix, each row sums per capita x population over its contracts, in their
+    stored order.
+    '''
+    rows = np.repeat(np.arange(reach.shape[0]), np.diff(reach.indptr))
+    served = sp.csr_matrix((pop[rows], reach.indices, reach.indptr), shape=reach.shape)
+    return served @ per_cap
+
+
+def scoreParallel(pairs, contracts, pop, max_dur, n_contracts, processes):
+    '''
+    scoreOrigins with a pool of processes, each scoring chunks of origins with about the same
+    number of pairs. The arrays are written to memory-mapped files which the workers share,
+    rather than being sent to each of them. The contract populations of the chunks are added
+    in chunk order, so the result does not depend on which worker finishes first (and with
+    whole numbers of people, it is the same as scoring in one process).
+    '''
+    n_origs = len(pop)
+    cuts = np.linspace(0, len(pairs['orig']), processes * CHUNKS_PER_PROCESS + 1)[1:-1].astype(int)
+    bounds = np.unique(np.r_[0, pairs['orig'][cuts] if len(pairs['orig']) else [], n_origs]).astype(int)
+    logger.info('Scoring {} chunks of origins with {} processes'.format(len(bounds) - 1, processes))
+
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as mmap_dir:
+        arrays = {'pop' : pop}
+        arrays.update({'pairs_' + name : array for name, array in pairs.items()})
+        arrays.update({'contracts_' + name : array for name, array in contracts.items()})
+        for name, array in arrays.items():
+            np.save(os.path.join(mmap_dir, name + '.npy'), array)
+        with ProcessPoolExecutor(processes, ctx, initializer=initWorker,
+                initargs=(mmap_dir, list(arrays), max_dur, n_contracts)) as executor:
+            results = list(executor.map(scoreChunk, bounds[:-1], bounds[1:]))
+
+    scores = np.concatenate([r[0] for r in results])
+    ppl = np.zeros(n_contracts)
+    for r in results:
+        ppl += r[1]
+    indptr = np.r_[0, np.cumsum(np.concatenate([np.diff(r[2].indptr) for r in results]))]
+    reach = sp.csr_matrix((np.concatenate([r[2].data for r in results]),
+        np.concatenate([r[2].indices for r in results]), indptr), shape=(n_origs, n_contracts))
+    return scores, ppl, reach
+
+
+# the memory-mapped arrays and settings of a worker process, set by initWorker
+worker_inputs = None
+
+
+def initWorker(mmap_dir, names, max_dur, n_contracts):
+    global worker_inputs
+    arrays = {name : np.load(os.path.join(mmap_dir, name + '.npy'), mmap_mode='r') for name in names}
+    pairs = {name[len('pairs_'):] : array for name, array in arrays.items() if name.startswith('pairs_')}
+    contracts = {name[len('contracts_'):] : array for name, array in arrays.items() if name.startswith('contracts_')}
+    worker_inputs = (pairs, contracts, arrays['pop'], max_dur, n_contracts)
+
+
+def scoreChunk(start, stop):
+    pairs, contracts, pop, max_dur, n_contracts = worker_inputs
+    return scoreOrigins(pairs, contracts, pop, max_dur, n_contracts, start, stop)
+
+
+def origContracts(services):
+    '''
+    The contracts in reach of each origin, once each, in the order they are first found
+    '''
+    order = np.lexsort((np.arange(len(services['orig'])), services['contract'], services['orig']))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (np.diff(services['orig'][order]) != 0) | (np.diff(services['contract'][order]) != 0)
+    return take(services, np.sort(order[first]))
+
+
+def take(arrays, index):
+    '''
+    The rows index (positions or a mask) of a dict of equal length arrays
+    '''
+    return {name : array[index] for name, array in arrays.items()}
+
+
+def rankInGroup(groups):
+    '''
+    The position of each element within its run of equal (sorted) group values
+    '''
+    if len(groups) == 0:
+        return np.zeros(0, dtype=int)
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    lengths = np.diff(np.r_[starts, len(groups)])
+    return np.arange(len(groups)) - np.repeat(starts, lengths)
+
+
+def linearDecay(times, upper):
+    '''
+    Vectorized calcHSSAscores.linearDecayFunction
+    '''
+    upper = float(upper)
+    times = times.astype(float)
+    return np.where(times > upper, 0, (upper - times) / upper)
@@ -0,0 +1,224 @@
+'''
+What-if scenarios for the HSSA scores: edit the contracts (budget, location, category) and
+get the scores and investments the full calculation (calcHSSAscores) would give, without
+running it again. The pairs, contracts and reach matrix of the city are kept in memory, and
+an edit only re-scores the origins within reach of the destinations it touches; the global
+steps (people per contract, investment, the rescale to the highest score and the contract
+z-scores of normalizeContractData) are vector operations over the whole city.
+'''
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+import time
+import logging
+import generalDBFunctions as db_fns
+import hssa_engine
+logger = logging.getLogger(__name__)
+
+
+class Scenario():
+    '''
+    The HSSA scores of the origins of a database (see calcHSSAscores.main) under edits to its
+    contracts. The edits are made in memory: the database is only read.
+    '''
+    def __init__(self, db, dem_col_name, max_dur):
+        start = time.time()
+        self.db = db
+        self.max_dur = max_dur
+        cursor = db.cursor()
+        origs = db_fns.getTable(cursor, 'orig', [0, hssa_engine.getColumn(cursor, 'orig', dem_col_name)],
+            ['orig_id', 'pop'])
+        self.orig_ids = origs.orig_id
+        self.pop = origs['pop'].values.astype(float)
+        self.pairs, self.dest_ids = hssa_engine.loadPairs(db, self.orig_ids)
+        self.indexPairs()
+
+        self.base = pd.read_sql_query('SELECT * FROM contracts', db)
+        # budgets can be scaled by any factor
+        self.base['TotalBudgt'] = self.base.TotalBudgt.astype(float)
+        self.contracts = self.base.copy()
+        self.arrays, self.amounts = hssa_engine.contractArrays(self.contracts, self.dest_ids)
+        n_origs = len(self.pop)
+        self.raw_scores, ppl, self.reach = hssa_engine.scoreOrigins(self.pairs, self.arrays, self.pop,
+            max_dur, len(self.amounts), 0, n_origs)
+        self.fund(ppl)
+        self.base_scores = self.scores()
+        logger.info('Scenario of {} origins and {} contracts ready ({} seconds)'.format(n_origs,
+            len(self.amounts), round(time.time() - start, 2)))
+
+    def indexPairs(self):
+        '''
+        Index the pairs (sorted by origin) by origin and by destination
+        '''
+        n_origs = len(self.pop)
+        self.orig_ptr = np.searchsorted(self.pairs['orig'], np.arange(n_origs + 1))
+        self.by_dest = np.argsort(self.pairs['dest'], kind='stable')
+        self.dest_ptr = np.r_[0, np.cumsum(np.bincount(self.pairs['dest'], minlength=len(self.dest_ids)))]
+
+    def edit(self, contract_no, at_dest=None, **values):
+        '''
+        Set the values (e.g. TotalBudgt=, dest_id=, Project=) of the rows of a contract,
+        or only of its rows at the destination at_dest, and re-score
+        '''
+        if 'ContractNo' in values:
+            raise ValueError('The ContractNo of a contract cannot be edited')
+        rows = self.contracts.ContractNo == contract_no
+        if at_dest is not None:
+            rows &= self.contracts.dest_id == at_dest
+        rows = np.flatnonzero(rows.values)
+        if len(rows) == 0:
+            raise KeyError('No rows of contract {}{}'.format(contract_no,
+                '' if at_dest is None else ' at {}'.format(at_dest)))
+        old_dests = list(self.contracts.dest_id.values[rows])
+        for column, value in values.items():
+            self.contracts.loc[self.contracts.index[rows], column] = value
+        self.rescore(old_dests + list(self.contracts.dest_id.values[rows]))
+
+    def scaleBudget(self, contract_no, factor):
+        '''
+        Multiply the budget of a contract by factor (e.g. 1.2 for +20%)
+        '''
+        rows = self.contracts.ContractNo == contract_no
+        if not rows.any():
+            raise KeyError('No rows of contract {}'.format(contract_no))
+        self.contracts.loc[rows, 'TotalBudgt'] = self.contracts.TotalBudgt[rows] * factor
+        self.rescore(list(self.contracts.dest_id[rows]))
+
+    def move(self, contract_no, dest_id, at_dest=None):
+        '''
+        Move a contract (or only its site at at_dest) to the destination dest_id
+        '''
+        self.edit(contract_no, at_dest, dest_id=dest_id)
+
+    def setCategory(self, contract_no, project):
+        self.edit(contract_no, Project=project)
+
+    def reset(self):
+        '''
+        Undo every edit
+        '''
+        changed = ~(self.contracts.eq(self.base) | (self.contracts.isna() & self.base.isna())).all(axis=1)
+        dests = list(self.contracts.dest_id[changed]) + list(self.base.dest_id[changed])
+        self.contracts = self.base.copy()
+        self.rescore(dests)
+
+    def rescore(self, dests):
+        '''
+        Re-score the origins within reach of the destinations (dest_ids) whose contracts changed,
+        and update the people per contract, the investments and the rescale
+        '''
+        start = time.time()
+        self.addDestinations(dests)
+        self.arrays, self.amounts = hssa_engine.contractArrays(self.contracts, self.dest_ids)
+        codes = pd.Index(self.dest_ids).get_indexer(pd.unique(pd.Series(dests)))
+        codes = codes[codes >= 0]
+        origs = np.unique(np.concatenate([[]] + [self.pairs['orig'][self.by_dest[self.dest_ptr[d]:self.dest_ptr[d + 1]]]
+            for d in codes]).astype(np.int64))
+
+        scores, reach = self.scoreOrigins(origs)
+        self.raw_scores[origs] = scores
+        self.reach = replaceRows(self.reach, origs, reach)
+        self.fund(self.reach.T @ self.pop)
+        logger.info('Re-scored {} origins ({} seconds)'.format(len(origs), round(time.time() - start, 3)))
+
+    def scoreOrigins(self, origs):
+        '''
+        The raw scores and reach matrix rows of a sorted array of origins (positions)
+        '''
+        lengths = self.orig_ptr[origs + 1] - self.orig_ptr[origs]
+        rows = np.repeat(self.orig_ptr[origs] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        chunk = hssa_engine.take(self.pairs, rows)
+        chunk['orig'] = np.repeat(np.arange(len(origs)), lengths)
+        services = hssa_engine.joinServices(chunk, self.arrays)
+        scores = hssa_engine.calcScores(hssa_engine.closestServices(services), self.max_dur, len(origs))
+        return scores, hssa_engine.reachMatrix(services, len(origs), len(self.amounts))
+
+    def addDestinations(self, dests):
+        '''
+        Add the pairs of the destinations which are not in destsubset (a contract moved to a
+        block which had none) from the walking table, as subset_database would have
+        '''
+        new = [d for d in pd.unique(pd.Series(dests)) if d not in set(self.dest_ids)]
+        if not new:
+            return
+        tables = db_fns.getTabNames(self.db)
+        if 'walking' not in tables:
+            raise ValueError('Cannot move contracts to {}: they are not in destsubset and there is no walking table'
+                .format(new))
+        query_str = 'SELECT orig_id, dest_id, duration FROM walking WHERE duration < ? AND dest_id IN ({})'.format(
+            ', '.join('?' * len(new)))
+        walking = pd.read_sql_query(query_str, self.db, params=[self.max_dur] + new)
+        walking = walking.drop_duplicates(['orig_id', 'dest_id'])
+        orig = pd.Index(self.orig_ids).get_indexer(walking.orig_id)
+        walking = walking[orig >= 0]
+        self.dest_ids = self.dest_ids.append(pd.Index(new))
+        added = {'orig' : orig[orig >= 0].astype(np.int64),
+            'dest' : pd.Index(self.dest_ids).get_indexer(walking.dest_id).astype(np.int64),
+            # destsubset keeps the walking times as whole seconds
+            'walking_time' : walking.duration.values.astype(int).astype(float)}
+        pairs = {name : np.r_[self.pairs[name], added[name]] for name in self.pairs}
+        self.pairs = hssa_engine.take(pairs, np.argsort(pairs['orig'], kind='stable'))
+        self.indexPairs()
+        logger.info('Added {} pairs of {} new destinations'.format(len(walking), len(new)))
+
+    def fund(self, ppl):
+        '''
+        The investment of every origin for the people per contract (ppl)
+        '''
+        self.ppl = ppl
+        self.investment = hssa_engine.fundOrigins(self.reach, hssa_engine.perCapita(self.amounts, ppl), self.pop)
+
+    def scores(self):
+        '''
+        The scores as calcHSSAscores.main writes them: a pd.DataFrame of orig_id, HSSAscore
+        (rescaled so the highest is 100) and investment
+        '''
+        scores_pd = pd.DataFrame({'orig_id' : self.orig_ids, 'HSSAscore' : self.raw_scores,
+            'investment' : self.investment})
+        scores_pd['HSSAscore'] = 100 * scores_pd['HSSAscore'].divide(max(scores_pd['HSSAscore']))
+        return scores_pd
+
+    def changes(self):
+        '''
+        The origins whose score or investment differ from before the edits, with both
+        '''
+        scores = self.scores()
+        changes = self.base_scores.merge(scores, on='orig_id', suffixes=('_base', ''))
+        changed = ((changes.HSSAscore_base != changes.HSSAscore) | (changes.investment_base != changes.investment))
+        return changes[changed.values]
+
+    def normalizedContracts(self):
+        '''
+        The contracts as normalizeContractData returns them: the total TotalBudgt of each
+        ContractNo (TotalBudgtOriginal), and its z-score shifted so the lowest is 0 (TotalBudgt)
+        '''
+        contract_nos = pd.unique(self.contracts.ContractNo)
+        normalized = (self.amounts - np.nanmean(self.amounts)) / np.nanstd(self.amounts)
+        normalized += abs(np.nanmin(normalized))
+        return pd.DataFrame({'ContractNo' : contract_nos, 'TotalBudgt' : normalized,
+            'TotalBudgtOriginal' : self.amounts})
+
+
+def replaceRows(matrix, rows, new_rows):
+    '''
+    A CSR matrix with its rows (sorted positions) replaced by the rows of new_rows,
+    keeping the order of the entries within each row
+    '''
+    lengths = np.diff(matrix.indptr)
+    new_lengths = np.diff(new_rows.indptr)
+    entry_rows = np.repeat(np.arange(matrix.shape[0]), lengths)
+    keep = np.ones(matrix.shape[0], dtype=bool)
+    keep[rows] = False
+    keep = keep[entry_rows]
+    lengths[rows] = new_lengths
+    indptr = np.r_[0, np.cumsum(lengths)]
+
+    # each entry goes to the start of its row in indptr plus its place within the row
+    at = (indptr[entry_rows] + np.arange(len(entry_rows)) - matrix.indptr[entry_rows])[keep]
+    new_at = np.repeat(indptr[rows] - new_rows.indptr[:-1], new_lengths) + np.arange(new_rows.nnz)
+    indices = np.empty(indptr[-1], dtype=matrix.indices.dtype)
+    data = np.empty(indptr[-1])
+    indices[at], data[at] = matrix.indices[keep], matrix.data[keep]
+    indices[new_at], data[new_at] = new_rows.indices, new_rows.data
+    return sp.csr_matrix((data, indices, indptr), shape=matrix.shape)
@@ -0,0 +1,166 @@
+'''
+Size the /table requests. Each request gets as many destinations as fit the URL length
+and the server's table size limit, and as keep the request latency near a target:
+the measured latency per matrix cell over recent requests sets the size of the next ones.
+Requests the server rejects as too big are split in half and retried.
+'''
+import copy
+import threading
+from collections import deque
+import logging
+from table_request import CoordLength
+logger = logging.getLogger(__name__)
+
+# matrix cells (sources x destinations) in the first requests
+START_SIZE = 500
+MIN_SIZE = 10
+# osrm-routed --max-table-size (sources x destinations <= max_table_size ** 2)
+MAX_TABLE_SIZE = 100
+# characters, well within the request size limits of common servers and proxies
+MAX_URL_LENGTH = 32 * 1024
+# characters of the URL other than the coordinates and their indices
+URL_OVERHEAD = 200
+# seconds per request
+TARGET_LATENCY = 1.0
+# requests in the rolling latency window
+WINDOW = 50
+
+
+class AdaptiveBatcher():
+    '''
+    Shared by the batch generator (Size, Fits), which reads it, and the query workers
+    (Record, Oversize), which update it - from several threads, hence the lock.
+    With adapt=False the size stays at size, but the limits and splitting still apply.
+    coords is how the coordinates are sent (see table_request.COORDS), and with distances
+    the requests ask for the network distances too.
+    hints are the snapped points of each mode (see SetHints), sent with its requests.
+    '''
+    def __init__(self, size=START_SIZE, adapt=True, target_latency=TARGET_LATENCY,
+            max_table_size=MAX_TABLE_SIZE, max_url_length=MAX_URL_LENGTH, window=WINDOW, coords='text',
+            distances=False):
+        self.cells = size
+        self.coords = coords
+        self.distances = distances
+        self.hints = {}
+        self.hint_length = 0
+        self.adapt = adapt
+        self.target_latency = target_latency
+        self.max_cells = max_table_size ** 2
+        self.max_url_length = max_url_length
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def Size(self, n_origs=1):
+        '''
+        The number of destinations for the next request from n_origs origins
+        '''
+        return max(1, min(self.cells, self.max_cells) // n_origs)
+
+    def CoordLength(self, index, lon, lat):
+        return CoordLength(index, lon, lat, self.coords) + self.hint_length
+
+    def SetHints(self, mode, hints):
+        '''
+        Send the hints ({orig_id : hint}, {dest_id : hint}, see snapping.ReadHints) with the
+        requests of mode. Every coordinate is then counted with the longest hint.
+        '''
+        self.hints[mode] = hints
+        self.hint_length = max([self.hint_length] + [len(hint) + 1 for points in hints for hint in points.values()])
+
+    def Fits(self, url_length):
+        '''
+        Whether a request of (an estimated) url_length characters of coordinates is acceptable
+        '''
+        return url_length + URL_OVERHEAD <= self.max_url_length
+
+    def Record(self, cells, seconds):
+        '''
+        Add the latency of a successful request of cells sources x destinations and resize
+        '''
+        if not self.adapt:
+            return
+        with self.lock:
+            self.latencies.append((cells, seconds))
+            cells = sum(l[0] for l in self.latencies)
+            per_cell = sum(l[1] for l in self.latencies) / cells
+            target = self.target_latency / per_cell if per_cell else self.max_cells
+            # at most double or halve at a time, so a single slow request does not swing the size
+            target = min(max(target, self.cells / 2), self.cells * 2)
+            self.cells = int(min(max(target, MIN_SIZE), self.max_cells))
+
+    def Oversize(self, cells):
+        '''
+        The server rejected a request of cells as too big: never ask for more than half of it again
+        '''
+        with self.lock:
+            if cells // 2 < self.max_cells:
+                self.max_cells = max(1, cells // 2)
+                self.cells = min(self.cells, self.max_cells)
+                logger.warning('A request of {} cells was too big, limiting requests to {} cells'.format(
+                    cells, self.max_cells))
+
+
+def Cells(pair):
+    '''
+    The size of the matrix requested for a batch
+    '''
+    return len(pair.origs) * len(pair.dests)
+
+
+def IsOversize(status, text):
+    '''
+    Whether an OSRM response says the request was too big (a too large table or URL)
+    '''
+    return status in (413, 414) or (status == 400 and 'TooBig' in text)
+
+
+def Without(pair, done):
+    '''
+    Take the set of (orig_id, dest_id) pairs done out of a batch, dropping the destinations
+    (and for tiles, origins) which no longer have a pair to query
+    '''
+    if pair.pairs is None:
+        # a single origin: query the destinations which are not done
+        pair.dests = [d for d in pair.dests if (pair.origs[0][0], d[0]) not in done]
+    else:
+        pair.pairs = set((o[0], d[0]) for o in pair.origs for d in pair.dests
+            if (o[0], d[0]) in pair.pairs) - done
+        orig_ids = set(p[0] for p in pair.pairs)
+        dest_ids = set(p[1] for p in pair.pairs)
+        pair.origs = [o for o in pair.origs if o[0] in orig_ids]
+        pair.dests = [d for d in pair.dests if d[0] in dest_ids]
+
+
+def Split(pair):
+    '''
+    Split a batch (OrigxMany or OrigxDestTile) in two, by its destinations or else its origins.
+    The first half keeps the key, cached rows and completion of the batch.
+    '''
+    if len(pair.dests) > 1:
+        middle = len(pair.dests) // 2
+        parts = [(pair.origs, pair.dests[:middle]), (pair.origs, pair.dests[middle:])]
+    elif len(pair.origs) > 1:
+        middle = len(pair.origs) // 2
+        parts = [(pair.origs[:middle], pair.dests), (pair.origs[middle:], pair.dests)]
+    else:
+        raise ValueError('Cannot split the batch from origin {}: a single pair is too big'.format(pair.origs[0][0]))
+
+    halves = []
+    for origs, dests in parts:
+        half = copy.copy(pair)
+        half.origs = origs
+        half.dests = dests
+        if pair.pairs is not None:
+            orig_ids = set(o[0] for o in origs)
+            dest_ids = set(d[0] for d in dests)
+            half.pairs = set(p for p in pair.pairs if p[0] in orig_ids and p[1] in dest_ids)
+            if not half.pairs:
+                continue
+        half.key = '{}:{}'.format(origs[0][0], dests[0][0])
+        half.cached = []
+        half.completion = None
+        halves.append(half)
+    halves[0].key = pair.key
+    halves[0].cached = pair.cached
+    halves[0].completion = pair.completion
+    return halves
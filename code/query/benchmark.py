@@ -0,0 +1,155 @@
+'''
+Benchmark the query stage end to end: query_osrm against the OSRM stand-in (see osrm_standin),
+for synthetic databases of a given number of O-D pairs. Reports the pairs per second and
+the peak memory of each run (and of its engine processes), so dispatch, batching and writer
+changes can be compared offline.
+'''
+# our functions
+import database
+import euclidean
+import osrm_standin
+import query_osrm
+# pip functions
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import resource
+import socket
+import sqlite3
+import tempfile
+import time
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+# destinations per origin in the synthetic databases
+N_DESTS = 1000
+# the points are spread over a square of about 8 km around (LON, LAT)
+LON = -122.33
+LAT = 47.62
+SPREAD = 0.05
+# euclidean limit (meters) which keeps every pair
+LIMIT = 10 ** 6
+
+
+def main(pairs=(10000, 100000), n_dests=N_DESTS, port=0, standin=None, out_fn=None, seed=0, **query_args):
+    '''
+    Run query_osrm.main (with query_args, e.g. engine='async') against a stand-in server
+    (an osrm_standin.StandIn) for a database of each number of pairs.
+    Each run is in a fresh process, so its peak memory is its own.
+    Returns the results, which are also logged and, if out_fn is given, appended to it as JSON lines.
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    port = port or FreePort()
+    server = ctx.Process(target=osrm_standin.Serve, args=(port, standin or osrm_standin.StandIn(seed=seed)), daemon=True)
+    server.start()
+    endpoint = 'http://localhost:{}'.format(port)
+
+    results = []
+    try:
+        for n_pairs in pairs:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                db_fn = os.path.join(tmp_dir, 'benchmark.db')
+                n_origs = int(math.ceil(n_pairs / n_dests))
+                MakeDatabase(db_fn, n_origs, n_dests, seed)
+                queue = ctx.Queue()
+                run = ctx.Process(target=RunCase, args=(queue, db_fn, endpoint, query_args))
+                run.start()
+                result = queue.get()
+                run.join()
+            result.update(n_origs=n_origs, n_dests=n_dests, query_args=query_args)
+            logger.info(('{pairs} pairs: {seconds} seconds, {pairs_per_sec} pairs/s, peak memory {peak_mb} MB'
+                + ' (engine processes: {children_peak_mb} MB)').format(**result))
+            results.append(result)
+            if out_fn:
+                with open(out_fn, 'a') as out:
+                    out.write(json.dumps(result) + '\n')
+    finally:
+        server.terminate()
+    return results
+
+
+def MakeDatabase(db_fn, n_origs, n_dests, seed=0):
+    '''
+    A database as query_osrm expects it (see database.Init): n_origs origins and n_dests
+    destinations at random in the square, and every pair of them in origxdest
+    '''
+    rand = np.random.RandomState(seed)
+    db = sqlite3.connect(db_fn)
+    points = {}
+    for source, n_points in [('orig', n_origs), ('dest', n_dests)]:
+        ids = np.array(['{}{:09d}'.format(source, i) for i in range(n_points)], dtype=object)
+        lon = LON + rand.uniform(-SPREAD, SPREAD, n_points)
+        lat = LAT + rand.uniform(-SPREAD, SPREAD, n_points) / 2
+        db.execute('CREATE TABLE {0}({0}_id VARCHAR (20), {0}_lon REAL, {0}_lat REAL)'.format(source))
+        db.executemany('INSERT INTO {0}({0}_id, {0}_lon, {0}_lat) VALUES(?, ?, ?)'.format(source),
+            zip(ids, lon.tolist(), lat.tolist()))
+        points[source] = (ids, lon, lat)
+    db.execute('CREATE TABLE origxdest(orig_id VARCHAR (15), dest_id VARCHAR (15), euclidean INTEGER)')
+    euclidean.insertWithinLimit(db, points['orig'], points['dest'], LIMIT)
+    db.commit()
+    db.close()
+    database.InitResults(db_fn, 'walking')
+
+
+def RunCase(queue, db_fn, endpoint, query_args):
+    '''
+    Query every pair of db_fn from endpoint and put the pairs, time and peak memory on queue
+    '''
+    logging.basicConfig(level=logging.WARNING)
+    start = time.time()
+    query_osrm.main(limit=LIMIT, db_fn=db_fn, endpoints=[endpoint], metrics_fn=None, **query_args)
+    seconds = time.time() - start
+
+    db = sqlite3.connect(db_fn)
+    n_pairs = db.execute('SELECT COUNT(*) FROM walking').fetchone()[0]
+    db.close()
+    # kilobytes on Linux: the peak of this process, and the largest peak of any engine
+    # process it ran (the peaks need not be at the same time, so they are not added)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_peak_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    queue.put({'pairs' : n_pairs, 'seconds' : round(seconds, 2), 'pairs_per_sec' : round(n_pairs / seconds),
+        'peak_mb' : round(peak_kb / 1024), 'children_peak_mb' : round(children_peak_kb / 1024)})
+
+
+def FreePort():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Benchmark query_osrm against a local OSRM stand-in')
+    parser.add_argument('--pairs', type=int, nargs='+', default=[10000, 100000], help='O-D pairs of each run')
+    parser.add_argument('--dests', type=int, default=N_DESTS, help='destinations (per origin)')
+    parser.add_argument('--out', help='file to append the results to, as JSON lines')
+    parser.add_argument('--seed', type=int, default=0)
+    # the stand-in
+    parser.add_argument('--port', type=int, default=0, help='port of the stand-in (default: any free port)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per request')
+    parser.add_argument('--latency-per-cell', type=float, default=0.0, help='seconds per source x destination')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failing with a 500 error')
+    parser.add_argument('--null-rate', type=float, default=0.0, help='share of destinations without a route')
+    parser.add_argument('--max-table-size', type=int, help='as osrm-routed --max-table-size')
+    # query_osrm
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--processes', action='store_true')
+    parser.add_argument('--tile', type=int, nargs=2, metavar=('M', 'N'))
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--fixed-size', action='store_true')
+    parser.add_argument('--coords', choices=['text', 'polyline', 'polyline6'], default='polyline6')
+    args = parser.parse_args()
+
+    standin = osrm_standin.StandIn(args.latency, args.latency_per_cell, args.error_rate, args.null_rate,
+        args.max_table_size, seed=args.seed)
+    query_args = {'engine' : args.engine, 'concurrency' : args.concurrency, 'processes' : args.processes,
+        'tile' : args.tile, 'adapt' : not args.fixed_size, 'coords' : args.coords}
+    if args.batch_size:
+        query_args['batch_size'] = args.batch_size
+    if args.max_table_size:
+        query_args['max_table_size'] = args.max_table_size
+    main(args.pairs, args.dests, args.port, standin, args.out, args.seed, **query_args)
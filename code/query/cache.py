@@ -0,0 +1,138 @@
+'''
+Persistent cache of OSRM travel times, shared across runs, limits and cities.
+Durations are keyed on (mode, rounded origin, rounded destination, OSRM dataset),
+so only pairs that have never been queried are sent to the server.
+'''
+import sqlite3
+import time
+import batching
+import logging
+logger = logging.getLogger(__name__)
+
+# coordinates are rounded to 5 decimal places (about 1 m)
+PRECISION = 5
+# the least recently used pairs are evicted above this size
+MAX_ROWS = 50 * 10 ** 6
+
+
+class TravelTimeCache():
+    '''
+    An sqlite cache of travel times (and network distances).
+    Lookups (Filter) are made from the dispatching thread and additions (Add)
+    from the writer thread, each on its own connection.
+    With distances, rows have a distance too, and pairs cached without one are queried again.
+    '''
+    def __init__(self, cache_fn, mode, dataset, max_rows=MAX_ROWS, precision=PRECISION, distances=False):
+        self.cache_fn = cache_fn
+        self.mode = mode
+        self.distances = distances
+        self.dataset = dataset
+        self.max_rows = max_rows
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self.read_db = sqlite3.connect(cache_fn)
+        self.read_db.execute('PRAGMA journal_mode=WAL')
+        self.read_db.execute('''CREATE TABLE IF NOT EXISTS cache(mode VARCHAR (20), dataset VARCHAR (40),
+            orig_lon INTEGER, orig_lat INTEGER, dest_lon INTEGER, dest_lat INTEGER, duration INTEGER, used INTEGER,
+            distance INTEGER)''')
+        columns = [row[1] for row in self.read_db.execute('PRAGMA table_info(cache)')]
+        if 'distance' not in columns:
+            self.read_db.execute('ALTER TABLE cache ADD COLUMN distance INTEGER')
+        self.read_db.execute('''CREATE UNIQUE INDEX IF NOT EXISTS cache_key_idx
+            ON cache(mode, dataset, orig_lon, orig_lat, dest_lon, dest_lat)''')
+        self.read_db.execute('CREATE INDEX IF NOT EXISTS cache_used_idx ON cache(used)')
+        self.read_db.commit()
+        # rounded coordinates of every id seen, for the rows coming back from the writer
+        self.orig_coords = {}
+        self.dest_coords = {}
+
+    def Round(self, lon, lat):
+        return (int(round(lon * 10 ** self.precision)), int(round(lat * 10 ** self.precision)))
+
+    def Filter(self, batches, writer):
+        '''
+        Take the cached pairs out of each batch. Batches which are fully cached are passed
+        straight to the writer; the others are yielded with only their uncached pairs
+        left to query (the cached rows are kept in pair.cached).
+        '''
+        for pair in batches:
+            self.Split(pair)
+            if pair.dests:
+                yield pair
+            else:
+                writer.put(pair.key, pair.cached)
+                if pair.completion:
+                    logger.info("{} percent completed querying task".format(pair.completion))
+
+    def Split(self, pair):
+        '''
+        Move the cached pairs of a batch into pair.cached, dropping the destinations
+        (and for tiles, origins) which no longer have a pair to query
+        '''
+        select_str = '''SELECT dest_lon, dest_lat, duration, distance FROM cache
+            WHERE mode = ? AND dataset = ? AND orig_lon = ? AND orig_lat = ?'''
+        for dest_id, dest_lon, dest_lat in pair.dests:
+            self.dest_coords[dest_id] = self.Round(dest_lon, dest_lat)
+
+        cached = []
+        for orig_id, orig_lon, orig_lat in pair.origs:
+            self.orig_coords[orig_id] = self.Round(orig_lon, orig_lat)
+            durations = {(row[0], row[1]) : row[2:] for row in
+                self.read_db.execute(select_str, (self.mode, self.dataset) + self.orig_coords[orig_id])}
+            if not durations:
+                continue
+            for dest_id, dest_lon, dest_lat in pair.dests:
+                if pair.pairs is not None and (orig_id, dest_id) not in pair.pairs:
+                    continue
+                # a NULL duration (no route) is cached too
+                if self.dest_coords[dest_id] not in durations:
+                    continue
+                duration, distance = durations[self.dest_coords[dest_id]]
+                if not self.distances:
+                    cached.append([orig_id, dest_id, duration])
+                elif distance is not None or duration is None:
+                    cached.append([orig_id, dest_id, duration, distance])
+        self.hits += len(cached)
+        if not cached:
+            self.misses += self.Size(pair)
+            return
+
+        pair.cached = cached
+        batching.Without(pair, set((row[0], row[1]) for row in cached))
+        self.misses += self.Size(pair)
+
+    def Size(self, pair):
+        '''
+        Number of pairs to query in a batch
+        '''
+        if pair.pairs is None:
+            return len(pair.dests)
+        return len(pair.pairs)
+
+    def Add(self, db, rows):
+        '''
+        Add (or refresh) the rows on connection db, which belongs to the calling (writer) thread
+        '''
+        used = int(time.time())
+        insert_str = '''INSERT OR REPLACE INTO cache(mode, dataset, orig_lon, orig_lat, dest_lon, dest_lat,
+            duration, distance, used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+        db.executemany(insert_str, [(self.mode, self.dataset) + self.orig_coords[row[0]]
+            + self.dest_coords[row[1]] + (row[2], row[3] if len(row) > 3 else None, used) for row in rows])
+        db.commit()
+
+    def Evict(self, db):
+        '''
+        Remove the least recently used rows above max_rows
+        '''
+        n_rows = db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        excess = n_rows - self.max_rows
+        if excess > 0:
+            db.execute('''DELETE FROM cache WHERE rowid IN
+                (SELECT rowid FROM cache ORDER BY used LIMIT ?)''', (excess,))
+            db.commit()
+            logger.info('Evicted {} rows from the travel time cache'.format(excess))
+
+    def Close(self):
+        self.read_db.close()
+        logger.info('Travel time cache: {} pairs found, {} pairs to query'.format(self.hits, self.misses))
@@ -5,16 +5,24 @@ import geopandas as gpd
 import pandas as pd
 import time
 import os
+import json
 import sqlite3
-import csv
 import logging
+from queue import Queue
+from threading import Thread
 logger = logging.getLogger(__name__)
 
-def Init(db_fn, orig_fn, dest_fn, db_temp_fn):
+# the batch_key of the row of the checkpoint table which records the plan of the run
+PLAN_KEY = ''
+
+def Init(db_fn, orig_fn, dest_fn, db_temp_fn, symmetric=False):
     '''
     Generate a Sqlite3 temp data file and a combined-data.db.
     Transfer data from shapefile to temp data holding.
+    With symmetric, the origins and destinations are the same points (see InitSymmetric).
     '''
+    if symmetric:
+        return InitSymmetric(db_fn, orig_fn, db_temp_fn)
 
     #Load shapefiles
     logger.info('Writing new {}'.format(db_fn))
@@ -80,26 +88,307 @@ def Init(db_fn, orig_fn, dest_fn, db_temp_fn):
     logger.info('Finished generating {} and {}'.format(db_fn,db_temp_fn))
 
 
-def Write(mode, temp_fn, db_fn):
-    #read to .db and clean up
-    logger.info('Transfering data to .db')
-    db_start = time.time()
+def InitSymmetric(db_fn, points_fn, db_temp_fn):
+    '''
+    Generate the databases for origins and destinations which are the same points:
+    a single point table, with the orig and dest views of it, and the pointxpoint table
+    for the euclidean distance of each pair of points once (see euclidean.calculateSymmetric),
+    which the origxdest view reads both ways (see CreateSymmetricViews).
+    '''
+    logger.info('Writing new symmetric {}'.format(db_fn))
+    points_df = ReadShapefile('orig', points_fn)
+    rows = list(zip(points_df.index, points_df['orig_lon'], points_df['orig_lat']))
+
+    if os.path.isfile(db_temp_fn):
+        os.remove(db_temp_fn)
+        logger.info('Deleting old {}'.format(db_temp_fn))
+
+    create_str = 'CREATE TABLE point(point_id VARCHAR (20), point_lon REAL, point_lat REAL)'
+    insert_str = 'INSERT INTO point(point_id, point_lon, point_lat) VALUES(?, ?, ?)'
+    for fn in [db_temp_fn, db_fn]:
+        db = sqlite3.connect(fn)
+        db.execute(create_str)
+        db.executemany(insert_str, rows)
+        db.commit()
+        db.close()
+
+    db = sqlite3.connect(db_fn)
+    db.execute('CREATE TABLE pointxpoint(orig_id VARCHAR (15), dest_id VARCHAR (15), euclidean INTEGER)')
+    CreateSymmetricViews(db)
+    db.execute('CREATE TABLE walking(orig_id VARCHAR (15), dest_id VARCHAR (15), duration INTEGER)')
+    db.commit()
+    db.close()
+    logger.info('Finished generating {} and {} ({} points)'.format(db_fn, db_temp_fn, len(rows)))
+
+
+def CreateSymmetricViews(db):
+    '''
+    The orig and dest views of the point table, and the origxdest view of every ordered pair:
+    the pointxpoint pairs (orig_id < dest_id) both ways, and each point with itself
+    '''
+    for source in ['orig', 'dest']:
+        db.execute('''CREATE VIEW {0} AS
+            SELECT point_id AS {0}_id, point_lon AS {0}_lon, point_lat AS {0}_lat FROM point'''.format(source))
+    db.execute('''CREATE VIEW origxdest AS
+        SELECT orig_id, dest_id, euclidean FROM pointxpoint
+        UNION ALL SELECT dest_id AS orig_id, orig_id AS dest_id, euclidean FROM pointxpoint
+        UNION ALL SELECT point_id AS orig_id, point_id AS dest_id, 0 AS euclidean FROM point''')
+
+
+def IsSymmetric(db):
+    '''
+    Whether the database was made by InitSymmetric
+    '''
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'point'").fetchone() is not None
 
-    db = sqlite3.connect(db_fn) 
-    cursor = db.cursor()
 
-    with open(temp_fn, 'r') as fin: 
-        dr = csv.DictReader(fin) 
-        to_db = [(i['0'], i['1'], i['2']) for i in dr]
-    insert_str = '''INSERT INTO {}(orig_id, dest_id, duration) VALUES (?, ?, ?)'''.format(mode)
-    cursor.executemany(insert_str, to_db)
+def Update(db_fn, orig_fn, dest_fn):
+    '''
+    Add the origins and destinations in the shapefiles that are not yet in the database.
+    Existing rows (and their results) are kept.
+    Returns the lists of new orig_ids and dest_ids.
+    In a symmetric database (see InitSymmetric), the points are read from orig_fn and
+    the new points are both new origins and new destinations.
+    '''
+    logger.info('Updating {}'.format(db_fn))
+    db = sqlite3.connect(db_fn)
+    new_ids = {}
+    sources = [('point', orig_fn)] if IsSymmetric(db) else [('orig', orig_fn), ('dest', dest_fn)]
+    for source, filename in sources:
+        df = ReadShapefile('orig' if source == 'point' else source, filename)
+        df.columns = [c.replace('orig_', source + '_') for c in df.columns]
+        existing = set(row[0] for row in db.execute('SELECT {0}_id FROM {0}'.format(source)))
+        new = df[~df.index.isin(existing)]
+
+        insert_str = 'INSERT INTO {0}({0}_id, {0}_lon, {0}_lat) VALUES(?, ?, ?)'.format(source)
+        db.executemany(insert_str, zip(new.index, new[source + '_lon'], new[source + '_lat']))
+        db.commit()
+
+        n_missing = len(existing - set(df.index))
+        logger.info('{}: {} new rows, {} rows not in {} are kept'.format(source, len(new), n_missing, filename))
+        new_ids[source] = list(new.index)
+    db.close()
+    if 'point' in new_ids:
+        return new_ids['point'], new_ids['point']
+    return new_ids['orig'], new_ids['dest']
+
+
+def InitResults(db_fn, mode, distances=False):
+    '''
+    Create the mode table if there is none (e.g. for a new OSRM profile), and with distances
+    add a distance column (meters) to it if it has none
+    '''
+    db = sqlite3.connect(db_fn)
+    db.execute('CREATE TABLE IF NOT EXISTS {}(orig_id VARCHAR (15), dest_id VARCHAR (15), duration INTEGER)'.format(mode))
+    columns = [row[1] for row in db.execute('PRAGMA table_info({})'.format(mode))]
+    if distances and 'distance' not in columns:
+        db.execute('ALTER TABLE {} ADD COLUMN distance INTEGER'.format(mode))
     db.commit()
+    db.close()
+
+
+def InitCheckpoint(db_fn, mode, plan, resume=False, keep_results=False):
+    '''
+    Create the checkpoint table, which records the plan of the run (in its PLAN_KEY row) and the
+    batches that have been written to the mode table (see WriteWorker), and the quarantine table
+    of the batches that failed (see failures.Quarantine).
+    plan describes which pairs the run calculates; a run can only be resumed with the same plan.
+    Unless resuming, clear the checkpoint, the quarantine and (unless keep_results) the mode table.
+    Returns the set of completed batch keys.
+    '''
+    checkpoint = '{}_checkpoint'.format(mode)
+    db = sqlite3.connect(db_fn)
+    db.execute('CREATE TABLE IF NOT EXISTS {}(batch_key VARCHAR (40) PRIMARY KEY, plan VARCHAR (20))'.format(checkpoint))
+    InitQuarantine(db, mode)
 
-    #Close connection to .db
+    if resume:
+        plans = [row[0] for row in db.execute('SELECT DISTINCT plan FROM {}'.format(checkpoint))]
+        if plans and plans != [plan]:
+            db.close()
+            raise ValueError('Cannot resume: the run was planned as {}, not {}'.format(plans, plan))
+        done = set(row[0] for row in db.execute('SELECT batch_key FROM {}'.format(checkpoint))) - {PLAN_KEY}
+        logger.info('Resuming: {} batches already completed'.format(len(done)))
+    else:
+        db.execute('DELETE FROM {}'.format(checkpoint))
+        db.execute('DELETE FROM {}_quarantine'.format(mode))
+        if not keep_results:
+            db.execute('DELETE FROM {}'.format(mode))
+            logger.info('Deleting old {} data'.format(mode))
+        done = set()
+    db.execute('INSERT OR REPLACE INTO {}(batch_key, plan) VALUES (?, ?)'.format(checkpoint), (PLAN_KEY, plan))
+    db.commit()
     db.close()
-    db_end = time.time()
-    logger.info('Transferred data to .db ({} seconds)'.format(db_end - db_start))
+    return done
+
+
+def InitQuarantine(db, mode):
+    db.execute('''CREATE TABLE IF NOT EXISTS {}_quarantine(batch_key VARCHAR (40) PRIMARY KEY,
+        pairs TEXT, error TEXT, failed_at INTEGER)'''.format(mode))
+
+
+def ReadQuarantine(db, mode):
+    '''
+    Get the quarantined batches as (batch_key, [(orig_id, dest_id), ...])
+    '''
+    InitQuarantine(db, mode)
+    rows = db.execute('SELECT batch_key, pairs FROM {}_quarantine'.format(mode)).fetchall()
+    return [(key, [tuple(p) for p in json.loads(pairs)]) for key, pairs in rows]
+
+
+class WriteWorker(Thread):
+    '''
+    The single thread which writes query results to the mode table, or to the table of
+    each of several modes (a list), whose query workers write through Mode.
+    Rows arrive on a bounded queue, so the query workers wait for the writer
+    rather than holding every result in memory, and are inserted in large transactions.
+    Each batch is recorded in the checkpoint table (unless checkpoint is False, for runs which
+    resume from the rows written) and taken out of the quarantine table in the same transaction
+    as its rows.
+    If caches ({mode : cache.TravelTimeCache}) are given, the rows are also added to them.
+    With distances, the rows have a distance, written to the distance column (see InitResults).
+    With mirror, each row is also written the other way round (dest_id to orig_id), for
+    travel times taken as symmetric (see symmetry.CheckSymmetry).
+    '''
+    def __init__(self, db_fn, mode, plan, queue_size=1000, transaction_rows=100000, caches=None,
+            checkpoint=True, distances=False, mirror=False):
+        Thread.__init__(self)
+        self.queue = Queue(queue_size)
+        self.caches = caches or {}
+        self.db_fn = db_fn
+        self.modes = [mode] if isinstance(mode, str) else list(mode)
+        self.plan = plan
+        self.transaction_rows = transaction_rows
+        self.checkpoint = checkpoint
+        self.distances = distances
+        self.mirror = mirror
+        self.rows_received = 0
+        self.rows_written = 0
+        self.rows_null = {mode : 0 for mode in self.modes}
+        self.mode_rows = {mode : 0 for mode in self.modes}
+        self.quarantined = {mode : 0 for mode in self.modes}
+        self.error = None
+        # write-ahead logging lets the writer commit while the pairs are still being read
+        db = sqlite3.connect(db_fn)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.close()
+
+    def put(self, key, rows, mode=None):
+        '''
+        Queue the list of (orig_id, dest_id, duration) rows for batch key (None for rows
+        which are not a batch), blocking if the writer is behind
+        '''
+        self.queue.put((mode or self.modes[0], key, rows, None))
+
+    def quarantine(self, key, pairs, error, mode=None):
+        '''
+        Queue a failed batch for the quarantine table: its pairs (as JSON) and the error
+        '''
+        self.queue.put((mode or self.modes[0], key, [], (key, pairs, error, int(time.time()))))
+
+    def Mode(self, mode):
+        '''
+        The writer for the query workers of one mode
+        '''
+        return ModeWriter(self, mode)
+
+    def close(self):
+        '''
+        Write any remaining rows and wait for the thread to finish
+        '''
+        self.queue.put(None)
+        self.join()
+        if self.error:
+            raise self.error
+        for mode in self.modes:
+            logger.info('Wrote {} rows to the {} table ({} unroutable, with a NULL duration)'.format(
+                self.mode_rows[mode], mode, self.rows_null[mode]))
+            if self.quarantined[mode]:
+                logger.warning('{} batches failed and are in the {}_quarantine table'.format(
+                    self.quarantined[mode], mode))
+
+    def run(self):
+        db = sqlite3.connect(self.db_fn)
+        cache_dbs = {mode : sqlite3.connect(cache.cache_fn) for mode, cache in self.caches.items()}
+        # the keys, rows and failures of each mode since the last commit
+        pending = {mode : ([], [], []) for mode in self.modes}
+        n_pending = 0
+        try:
+            item = self.queue.get()
+            while item is not None:
+                mode, key, rows, failure = item
+                keys, mode_rows, failed = pending[mode]
+                if failure:
+                    failed.append(failure)
+                elif key is not None:
+                    keys.append(key)
+                mode_rows.extend(rows)
+                n_pending += len(rows)
+                self.rows_received += len(rows)
+                if n_pending >= self.transaction_rows:
+                    self.commit(db, pending, cache_dbs)
+                    pending = {mode : ([], [], []) for mode in self.modes}
+                    n_pending = 0
+                item = self.queue.get()
+            self.commit(db, pending, cache_dbs)
+            for mode, cache in self.caches.items():
+                cache.Evict(cache_dbs[mode])
+        except Exception as e:
+            logger.exception('Writing to {} failed'.format(self.db_fn))
+            self.error = e
+            # keep draining so the query workers are not blocked forever
+            while item is not None:
+                item = self.queue.get()
+        finally:
+            db.close()
+            for cache_db in cache_dbs.values():
+                cache_db.close()
+
+    def commit(self, db, pending, cache_dbs):
+        '''
+        Write the pending keys, rows and failures of every mode in one transaction
+        '''
+        for mode, (keys, rows, failed) in pending.items():
+            if self.distances:
+                insert_str = 'INSERT INTO {}(orig_id, dest_id, duration, distance) VALUES (?, ?, ?, ?)'.format(mode)
+            else:
+                insert_str = 'INSERT INTO {}(orig_id, dest_id, duration) VALUES (?, ?, ?)'.format(mode)
+            checkpoint_str = '''INSERT OR REPLACE INTO {}_checkpoint(batch_key, plan) VALUES (?, ?)'''.format(mode)
+            release_str = '''DELETE FROM {}_quarantine WHERE batch_key = ?'''.format(mode)
+            quarantine_str = '''INSERT OR REPLACE INTO {}_quarantine(batch_key, pairs, error, failed_at)
+                VALUES (?, ?, ?, ?)'''.format(mode)
+            db.executemany(insert_str, rows)
+            if self.mirror:
+                mirrored = [(row[1], row[0]) + tuple(row[2:]) for row in rows if row[0] != row[1]]
+                db.executemany(insert_str, mirrored)
+                self.mode_rows[mode] += len(mirrored)
+                self.rows_null[mode] += sum(1 for row in mirrored if row[2] is None)
+            if self.checkpoint:
+                db.executemany(checkpoint_str, [(key, self.plan) for key in keys])
+            db.executemany(release_str, [(key,) for key in keys])
+            db.executemany(quarantine_str, failed)
+        db.commit()
+        for mode, (keys, rows, failed) in pending.items():
+            self.rows_written += len(rows)
+            self.mode_rows[mode] += len(rows)
+            self.rows_null[mode] += sum(1 for row in rows if row[2] is None)
+            self.quarantined[mode] += len(failed)
+            if mode in cache_dbs:
+                self.caches[mode].Add(cache_dbs[mode], rows)
+
+
+class ModeWriter():
+    '''
+    Passes the results of one mode's query workers to the WriteWorker
+    '''
+    def __init__(self, writer, mode):
+        self.writer = writer
+        self.mode = mode
+
+    def put(self, key, rows):
+        self.writer.put(key, rows, self.mode)
 
+    def quarantine(self, key, pairs, error):
+        self.writer.quarantine(key, pairs, error, self.mode)
 
 
 def ReadShapefile(source, filename, sample = False):
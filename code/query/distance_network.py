@@ -1,7 +1,311 @@
 '''
-Calculate/query the network distance
+Calculate/query the network distance without an OSRM server: a pedestrian graph is built
+once from an OpenStreetMap extract (.osm XML, optionally .gz or .bz2), cached as compressed
+sparse arrays, and the walking times from each chunk of origins are found with a
+cutoff-bounded Dijkstra (scipy.sparse.csgraph), in parallel processes.
+The times are written to the same walking table as query_osrm.
 '''
-from threading import Thread
+# our functions
+import database
+import planner
+from euclidean import EARTH_RADIUS, unitSphere
+# pip functions
+import argparse
+import bz2
+import gzip
+import multiprocessing
+import os
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra, connected_components
+from scipy.spatial import cKDTree
 import logging
 logger = logging.getLogger(__name__)
 
+# file names
+osm_fn = '../data/osm/seattle.osm'
+db_fn = '../query_results/por_5km.db'
+
+# m/s, as OSRM's foot profile (5 km/h)
+WALK_SPEED = 5 / 3.6
+# the highways a pedestrian can use, and the access tags which close them
+FOOT_HIGHWAYS = set(['primary', 'primary_link', 'secondary', 'secondary_link', 'tertiary', 'tertiary_link',
+    'unclassified', 'residential', 'living_street', 'service', 'road', 'track', 'path', 'footway',
+    'pedestrian', 'steps', 'cycleway', 'bridleway', 'corridor', 'platform', 'trunk', 'trunk_link'])
+NO_ACCESS = set(['no', 'private'])
+# without max_dur, pairs are searched up to this many times their euclidean limit walked
+MAX_DETOUR = 2
+# memory for the travel times from each chunk of origins (a dense origins x nodes array)
+MEMORY_BUDGET = 256 * 1024 ** 2
+MAX_CHUNK = 256
+
+
+def main(osm_fn=osm_fn, db_fn=db_fn, mode='walking', limit=5000, max_dur=None, services=None,
+        resume=False, processes=None, graph_fn=None):
+    '''
+    Fill the mode table of db_fn (which must have its origxdest pairs, see query_osrm)
+    with the walking times over the network in osm_fn:
+        - limit, max_dur, services: the pairs to calculate, as query_osrm (see planner.PlanPairs).
+          Pairs which cannot be reached within max_dur (or, without it, MAX_DETOUR x the limit
+          walked) have a NULL duration.
+        - resume: keep the results of a previous run, and only calculate the origins
+          which are not in its checkpoint table
+        - processes: Dijkstra processes (default: one per core)
+        - graph_fn: the cached graph (default: osm_fn + '.walk.npz'), built if it is older than osm_fn
+    '''
+    start = time.time()
+    graph_fn = graph_fn or osm_fn + '.walk.npz'
+    graph = LoadGraph(osm_fn, graph_fn)
+    cutoff = max_dur if max_dur is not None else MAX_DETOUR * limit / WALK_SPEED
+    processes = processes or multiprocessing.cpu_count()
+
+    plan = 'network-services{}'.format(max_dur or '') if services or max_dur else 'network'
+    database.InitResults(db_fn, mode)
+    done = database.InitCheckpoint(db_fn, mode, plan, resume)
+    writer = database.WriteWorker(db_fn, mode, plan)
+    writer.start()
+
+    db = sqlite3.connect(db_fn)
+    dest_ids = planner.ServiceDestinations(services) if services else None
+    planner.PlanPairs(db, limit, dest_ids, max_dur)
+    n_pairs = db.execute('SELECT COUNT(*) FROM plan_pairs').fetchone()[0]
+    logger.info('Pairs to calculate: {} (cutoff {} seconds)'.format(n_pairs, round(cutoff)))
+
+    # at most MAX_CHUNK origins, and a chunk's times (8 bytes per node) within the budget
+    chunk_size = int(min(MAX_CHUNK, max(1, MEMORY_BUDGET // (8 * len(graph['lon'])))))
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(processes, ctx, initializer=InitWorker, initargs=(graph_fn,)) as executor:
+        # a bounded number of chunks in flight, so the plan is read as fast as it is calculated
+        in_flight = deque()
+        for chunk in Chunks(planner.PlanRows(db), graph, chunk_size):
+            if chunk.key in done:
+                continue
+            in_flight.append((chunk, executor.submit(ChunkTimes, chunk.orig_nodes, chunk.pair_origs,
+                chunk.pair_dest_nodes, cutoff)))
+            if len(in_flight) >= 2 * processes:
+                WriteChunk(*in_flight.popleft(), cutoff, writer)
+        while in_flight:
+            WriteChunk(*in_flight.popleft(), cutoff, writer)
+    db.close()
+    writer.close()
+    logger.info('Calculated {} pairs over the network ({} seconds)'.format(n_pairs, round(time.time() - start, 1)))
+
+
+def LoadGraph(osm_fn, graph_fn):
+    '''
+    Load the pedestrian graph from graph_fn, building (and saving) it from osm_fn first
+    if there is none or it is older than osm_fn
+    '''
+    if not os.path.isfile(graph_fn) or os.path.getmtime(graph_fn) < os.path.getmtime(osm_fn):
+        graph = BuildGraph(osm_fn)
+        np.savez_compressed(graph_fn, **graph)
+        logger.info('Saved the graph to {}'.format(graph_fn))
+    graph = dict(np.load(graph_fn))
+    logger.info('Loaded the graph: {} nodes, {} edges'.format(len(graph['lon']), len(graph['indices'])))
+    return graph
+
+
+def BuildGraph(osm_fn):
+    '''
+    Build the pedestrian graph of an OSM extract as CSR arrays: indptr, indices and data
+    (the seconds to walk each edge, once per pair of nodes, both ways being the same),
+    the lon and lat of the nodes, and snappable, the nodes in the largest connected component
+    '''
+    logger.info('Building the pedestrian graph from {}'.format(osm_fn))
+    coords, ways = ReadOSM(osm_fn)
+
+    # number the nodes used by the ways
+    node_ids = {}
+    starts = []
+    ends = []
+    for way in ways:
+        nodes = [node_ids.setdefault(ref, len(node_ids)) for ref in way if ref in coords]
+        starts.extend(nodes[:-1])
+        ends.extend(nodes[1:])
+    lonlat = np.array([coords[ref] for ref in sorted(node_ids, key=node_ids.get)], dtype=float).reshape(-1, 2)
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+
+    # each edge once, from the lower node, keeping the shortest of any duplicates
+    lower = np.minimum(starts, ends)
+    upper = np.maximum(starts, ends)
+    keep = lower != upper
+    lower, upper = lower[keep], upper[keep]
+    seconds = EdgeMeters(lonlat[lower], lonlat[upper]) / WALK_SPEED
+    order = np.lexsort((seconds, upper, lower))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (lower[order][1:] != lower[order][:-1]) | (upper[order][1:] != upper[order][:-1])
+    order = order[first]
+    n_nodes = len(lonlat)
+    matrix = csr_matrix((seconds[order], (lower[order], upper[order])), shape=(n_nodes, n_nodes))
+
+    # points are only snapped to the largest component, not to an isolated path
+    n_components, labels = connected_components(matrix, directed=False)
+    snappable = labels == np.bincount(labels).argmax() if n_nodes else np.zeros(0, dtype=bool)
+    logger.info('Built the graph: {} nodes, {} edges, {} components'.format(n_nodes, len(order), n_components))
+    return {'indptr' : matrix.indptr, 'indices' : matrix.indices, 'data' : matrix.data,
+        'lon' : lonlat[:, 0], 'lat' : lonlat[:, 1], 'snappable' : snappable}
+
+
+def ReadOSM(osm_fn):
+    '''
+    Read the node coordinates {id : (lon, lat)} and the ways a pedestrian can walk
+    (as lists of node ids) from an OSM XML file
+    '''
+    if osm_fn.endswith('.pbf'):
+        raise ValueError('{} is PBF: convert it to XML first, e.g. osmium cat {} -o extract.osm'.format(osm_fn, osm_fn))
+    opener = {'.gz' : gzip.open, '.bz2' : bz2.open}.get(os.path.splitext(osm_fn)[1], open)
+    coords = {}
+    ways = []
+    with opener(osm_fn, 'rb') as f:
+        for event, elem in ET.iterparse(f):
+            if elem.tag == 'node':
+                coords[elem.get('id')] = (float(elem.get('lon')), float(elem.get('lat')))
+                elem.clear()
+            elif elem.tag == 'way':
+                tags = {tag.get('k') : tag.get('v') for tag in elem.iter('tag')}
+                if IsWalkable(tags):
+                    ways.append([nd.get('ref') for nd in elem.iter('nd')])
+                elem.clear()
+    logger.info('Read {} nodes and {} walkable ways from {}'.format(len(coords), len(ways), osm_fn))
+    return coords, ways
+
+
+def IsWalkable(tags):
+    '''
+    Whether a pedestrian can use a way with tags: a highway of FOOT_HIGHWAYS (or any
+    highway tagged for foot) which is not closed to them
+    '''
+    highway = tags.get('highway')
+    if highway is None or tags.get('area') == 'yes':
+        return False
+    if tags.get('foot') in NO_ACCESS:
+        return False
+    if tags.get('foot') in ('yes', 'designated', 'permissive'):
+        return True
+    return highway in FOOT_HIGHWAYS and tags.get('access') not in NO_ACCESS
+
+
+def EdgeMeters(a, b):
+    '''
+    The great circle distances (meters, unrounded) between the (lon, lat) rows of a and b
+    '''
+    lon1, lat1, lon2, lat2 = np.radians(a[:, 0]), np.radians(a[:, 1]), np.radians(b[:, 0]), np.radians(b[:, 1])
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(h))
+
+
+class Snapper():
+    '''
+    Snaps points to the nearest snappable node of the graph, remembering each point (by id)
+    '''
+    def __init__(self, graph):
+        self.nodes = np.flatnonzero(graph['snappable'])
+        self.lonlat = np.column_stack((graph['lon'], graph['lat']))
+        self.tree = cKDTree(unitSphere(graph['lon'][self.nodes], graph['lat'][self.nodes]))
+        self.snapped = {}
+
+    def Snap(self, point_id, lon, lat):
+        '''
+        The node a point is snapped to, and the seconds walked to it
+        '''
+        if point_id not in self.snapped:
+            dist, i = self.tree.query(unitSphere(np.array([lon]), np.array([lat])))
+            node = self.nodes[i[0]]
+            meters = EdgeMeters(np.array([[lon, lat]]), self.lonlat[node:node + 1])[0]
+            self.snapped[point_id] = (node, meters / WALK_SPEED)
+        return self.snapped[point_id]
+
+
+class OrigChunk():
+    '''
+    The pairs of a chunk of origins, with the graph nodes they are snapped to:
+    orig_nodes (one per origin), and for each pair the row of its origin (pair_origs)
+    and the node of its destination (pair_dest_nodes)
+    '''
+    def __init__(self, pairs, orig_nodes, pair_origs, pair_dest_nodes, snap_seconds):
+        self.pairs = pairs
+        self.orig_nodes = np.array(orig_nodes, dtype=np.int64)
+        self.pair_origs = np.array(pair_origs, dtype=np.int64)
+        self.pair_dest_nodes = np.array(pair_dest_nodes, dtype=np.int64)
+        # the seconds walked between the points and their nodes, for each pair
+        self.snap_seconds = np.array(snap_seconds, dtype=float)
+        self.key = 'network:{}'.format(pairs[0][0])
+
+
+def Chunks(rows, graph, chunk_size):
+    '''
+    Group the O-D pairs from rows (see planner.PlanRows) into OrigChunks of chunk_size origins.
+    Rows are expected to arrive grouped by origin.
+    '''
+    snapper = Snapper(graph)
+    pairs, orig_nodes, pair_origs, pair_dest_nodes, snap_seconds = [], [], [], [], []
+    prev_orig = None
+    for orig_id, dest_id, orig_lon, orig_lat, dest_lon, dest_lat in rows:
+        if orig_id != prev_orig:
+            if len(orig_nodes) == chunk_size:
+                yield OrigChunk(pairs, orig_nodes, pair_origs, pair_dest_nodes, snap_seconds)
+                pairs, orig_nodes, pair_origs, pair_dest_nodes, snap_seconds = [], [], [], [], []
+            orig_node, orig_seconds = snapper.Snap(('orig', orig_id), orig_lon, orig_lat)
+            orig_nodes.append(orig_node)
+            prev_orig = orig_id
+        dest_node, dest_seconds = snapper.Snap(('dest', dest_id), dest_lon, dest_lat)
+        pairs.append((orig_id, dest_id))
+        pair_origs.append(len(orig_nodes) - 1)
+        pair_dest_nodes.append(dest_node)
+        snap_seconds.append(orig_seconds + dest_seconds)
+    if pairs:
+        yield OrigChunk(pairs, orig_nodes, pair_origs, pair_dest_nodes, snap_seconds)
+
+
+# the graph of a worker process, loaded once by InitWorker
+worker_graph = None
+
+
+def InitWorker(graph_fn):
+    global worker_graph
+    graph = np.load(graph_fn)
+    n_nodes = len(graph['lon'])
+    worker_graph = csr_matrix((graph['data'], graph['indices'], graph['indptr']), shape=(n_nodes, n_nodes))
+
+
+def ChunkTimes(orig_nodes, pair_origs, pair_dest_nodes, cutoff):
+    '''
+    The seconds over the network for each pair of a chunk (inf if beyond cutoff), with one
+    Dijkstra from all of the chunk's origin nodes, stopped at cutoff
+    '''
+    times = dijkstra(worker_graph, directed=False, indices=orig_nodes, limit=cutoff)
+    return times[pair_origs, pair_dest_nodes]
+
+
+def WriteChunk(chunk, future, cutoff, writer):
+    '''
+    Pass the rows of a calculated chunk to the writer (database.WriteWorker).
+    The duration is None for a pair which cannot be reached within cutoff.
+    '''
+    seconds = future.result() + chunk.snap_seconds
+    durations = [int(s) if s <= cutoff else None for s in seconds.tolist()]
+    writer.put(chunk.key, [[orig_id, dest_id, duration] for (orig_id, dest_id), duration
+        in zip(chunk.pairs, durations)])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Calculate the walking time between O-D pairs over an OSM network')
+    parser.add_argument('--osm', default=osm_fn, help='OpenStreetMap extract (.osm, .osm.gz or .osm.bz2)')
+    parser.add_argument('--graph', help='cached graph (default: the extract + .walk.npz)')
+    parser.add_argument('--db', default=db_fn, help='database with the origxdest pairs (see query_osrm)')
+    parser.add_argument('--mode', default='walking', help='table to write the times to')
+    parser.add_argument('--limit', type=int, default=5000, help='euclidean distance limit (meters)')
+    parser.add_argument('--max-dur', type=int, help='skip pairs that cannot be walked within this many seconds')
+    parser.add_argument('--services', help='database with a contracts table: only calculate pairs to services')
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted run from its checkpoint')
+    parser.add_argument('--processes', type=int, help='Dijkstra processes (default: one per core)')
+    args = parser.parse_args()
+    main(args.osm, args.db, args.mode, args.limit, args.max_dur, args.services, args.resume,
+        args.processes, args.graph)
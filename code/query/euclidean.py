@@ -1,40 +1,61 @@
 '''
 Calculate the Euclidean distance between all points to inform the querying
 '''
+import database
 import time
 import sqlite3
 from math import radians, cos, sin, asin, sqrt
 import os
 import logging
+import numpy as np
+from scipy.spatial import cKDTree
 logger = logging.getLogger(__name__)
 
+# 6367 km is the radius of the Earth (as in haversine)
+EARTH_RADIUS = 6367000
+# number of origins searched at a time by the spatial index
+CHUNK_SIZE = 2000
+# memory for each block of pairs when calculating all pairs, and the approximate
+# cost of one pair (the distance arrays plus the row passed to sqlite)
+MEMORY_BUDGET = 256 * 1024 ** 2
+BYTES_PER_PAIR = 200
 
-def calculate(mode, db_fn, db_temp_fn):
+
+def calculate(mode, db_fn, db_temp_fn, limit=None, memory_budget=MEMORY_BUDGET, symmetric=False):
     '''
     Generate the euclidean distance for each orig, dest pair.
+    If a limit (meters) is given, only the pairs closer than the limit are
+    found (with a spatial index) and added to origxdest.
+    memory_budget (bytes) sets how many origins are calculated and inserted at a time.
+    With symmetric, each pair of points is calculated once (see calculateSymmetric).
     '''
+    if symmetric:
+        return calculateSymmetric(db_fn, db_temp_fn, limit, memory_budget)
+    if limit is not None:
+        return calculateWithinLimit(db_fn, db_temp_fn, limit)
+
     logger.info('Calculating euclidean distances')
     start = time.time()
     
     #Initialize conneciton to .db's
     db = sqlite3.connect(db_temp_fn)
-    cursor = db.cursor()
     db1 = sqlite3.connect(db_fn)
-    cursor1 = db1.cursor()
-
-    #Add function to cursor and execute query
-    db.create_function("haversine", 4, haversine)
-    cursor.execute('''SELECT orig_id, dest_id,
-    haversine(orig_lon, orig_lat, dest_lon, dest_lat) as euclidean
-    FROM orig CROSS JOIN dest''')
-
-    #Iterate over each pair in .db until none remain
-    data = cursor.fetchmany(1000)
-    while data:
-        insert_str = 'INSERT INTO origxdest(orig_id, dest_id, euclidean) VALUES(?, ?, ?)'
-        cursor1.executemany(insert_str,(data))
+
+    orig_ids, orig_lon, orig_lat = readPoints(db, 'orig')
+    dest_ids, dest_lon, dest_lat = readPoints(db, 'dest')
+
+    # size the chunks of origins so that each block of distances (and its rows) fits in the budget
+    chunk_size = max(1, int(memory_budget // (BYTES_PER_PAIR * max(1, len(dest_ids)))))
+    logger.info('Calculating {} origins at a time'.format(chunk_size))
+
+    #Compute each block of origins x all destinations and insert it in one transaction
+    insert_str = 'INSERT INTO origxdest(orig_id, dest_id, euclidean) VALUES(?, ?, ?)'
+    for i in range(0, len(orig_ids), chunk_size):
+        j = min(i + chunk_size, len(orig_ids))
+        meters = haversineArray(orig_lon[i:j, None], orig_lat[i:j, None], dest_lon[None, :], dest_lat[None, :])
+        db1.executemany(insert_str, zip(np.repeat(orig_ids[i:j], len(dest_ids)),
+            np.tile(dest_ids, j - i), meters.ravel().tolist()))
         db1.commit()
-        data = cursor.fetchmany(1000)
 
     #Close up connections and delete temporary data
     db.close()
@@ -46,6 +67,184 @@ def calculate(mode, db_fn, db_temp_fn):
     logger.info('Finished calculating distances ({} seconds)'.format(end - start))
 
 
+def calculateWithinLimit(db_fn, db_temp_fn, limit):
+    '''
+    Generate the euclidean distance for the orig, dest pairs with distance < limit,
+    using a spatial index (see insertWithinLimit).
+    '''
+    logger.info('Calculating euclidean distances within {} meters'.format(limit))
+    start = time.time()
+
+    #Initialize conneciton to .db's
+    db = sqlite3.connect(db_temp_fn)
+    db1 = sqlite3.connect(db_fn)
+
+    origs = readPoints(db, 'orig')
+    dests = readPoints(db, 'dest')
+    n_pairs = insertWithinLimit(db1, origs, dests, limit)
+
+    #Close up connections and delete temporary data
+    db.close()
+    db1.close()
+    end = time.time()
+    if os.path.isfile(db_temp_fn):
+        os.remove(db_temp_fn)
+        logger.info('Cleaning up...')
+    logger.info('Finished calculating distances: {} pairs ({} seconds)'.format(n_pairs, end - start))
+
+
+def calculateSymmetric(db_fn, db_temp_fn, limit=None, memory_budget=MEMORY_BUDGET):
+    '''
+    Generate the euclidean distance for each pair of points of a symmetric database
+    (see database.InitSymmetric) once, into pointxpoint as orig_id < dest_id: the upper
+    triangle of the distance matrix, which the origxdest view mirrors.
+    If a limit (meters) is given, only the pairs closer than the limit are added.
+    '''
+    logger.info('Calculating symmetric euclidean distances' +
+        ('' if limit is None else ' within {} meters'.format(limit)))
+    start = time.time()
+
+    db = sqlite3.connect(db_temp_fn)
+    db1 = sqlite3.connect(db_fn)
+    points = readPoints(db, 'point')
+
+    if limit is not None:
+        n_pairs = insertWithinLimit(db1, points, points, limit, upper=True)
+    else:
+        # in id order, the upper triangle of a block of rows is the columns after each row
+        order = np.argsort(points[0], kind='stable')
+        ids, lon, lat = [x[order] for x in points]
+        chunk_size = max(1, int(memory_budget // (BYTES_PER_PAIR * max(1, len(ids)))))
+        insert_str = 'INSERT INTO pointxpoint(orig_id, dest_id, euclidean) VALUES(?, ?, ?)'
+        n_pairs = 0
+        for i in range(0, len(ids), chunk_size):
+            j = min(i + chunk_size, len(ids))
+            meters = haversineArray(lon[i:j, None], lat[i:j, None], lon[None, i:], lat[None, i:])
+            rows, cols = np.nonzero(np.arange(len(ids) - i)[None, :] > np.arange(j - i)[:, None])
+            db1.executemany(insert_str, zip(ids[i + rows], ids[i + cols], meters[rows, cols].tolist()))
+            db1.commit()
+            n_pairs += len(rows)
+
+    db.close()
+    db1.close()
+    end = time.time()
+    if os.path.isfile(db_temp_fn):
+        os.remove(db_temp_fn)
+        logger.info('Cleaning up...')
+    logger.info('Finished calculating distances: {} pairs of points ({} seconds)'.format(n_pairs, end - start))
+
+
+def calculateNew(db_fn, limit, new_orig_ids, new_dest_ids):
+    '''
+    Add the pairs with distance < limit which involve a new origin or destination
+    (see database.Update) to origxdest: new origins x all destinations, and
+    the existing origins x new destinations.
+    In a symmetric database the same pairs are added to pointxpoint, each once.
+    '''
+    logger.info('Calculating euclidean distances within {} meters for {} new origins and {} new destinations'
+        .format(limit, len(new_orig_ids), len(new_dest_ids)))
+    start = time.time()
+
+    db = sqlite3.connect(db_fn)
+    symmetric = database.IsSymmetric(db)
+    origs = readPoints(db, 'point' if symmetric else 'orig')
+    dests = origs if symmetric else readPoints(db, 'dest')
+    is_new_orig = np.isin(origs[0], list(new_orig_ids))
+    is_new_dest = np.isin(dests[0], list(new_dest_ids))
+
+    n_pairs = insertWithinLimit(db, [x[is_new_orig] for x in origs], dests, limit, upper=symmetric)
+    n_pairs += insertWithinLimit(db, [x[~is_new_orig] for x in origs], [x[is_new_dest] for x in dests], limit,
+        upper=symmetric)
+
+    db.close()
+    end = time.time()
+    logger.info('Finished calculating distances: {} new pairs ({} seconds)'.format(n_pairs, end - start))
+
+
+def insertWithinLimit(db, origs, dests, limit, upper=False):
+    '''
+    Insert the pairs of origs x dests (each as ids, lon, lat arrays) with distance < limit
+    into origxdest, and return the number of pairs.
+    With upper, only the pairs with orig_id < dest_id are inserted, into pointxpoint
+    (see calculateSymmetric).
+    The points are placed on the unit sphere and a KD-tree of the destinations is searched
+    for each chunk of origins, using the chord length equivalent to the limit.
+    '''
+    orig_ids, orig_lon, orig_lat = origs
+    dest_ids, dest_lon, dest_lat = dests
+    if len(orig_ids) == 0 or len(dest_ids) == 0:
+        return 0
+    orig_xyz = unitSphere(orig_lon, orig_lat)
+    dest_xyz = unitSphere(dest_lon, dest_lat)
+    tree = cKDTree(dest_xyz)
+    # chord on the unit sphere for the limit, padded slightly as the exact distance is checked below
+    radius = 2 * np.sin(limit / (2 * EARTH_RADIUS)) * (1 + 1e-9)
+
+    insert_str = 'INSERT INTO {}(orig_id, dest_id, euclidean) VALUES(?, ?, ?)'.format(
+        'pointxpoint' if upper else 'origxdest')
+    n_pairs = 0
+    for i in range(0, len(orig_ids), CHUNK_SIZE):
+        neighbours = tree.query_ball_point(orig_xyz[i:i + CHUNK_SIZE], radius)
+        counts = [len(n) for n in neighbours]
+        if sum(counts) == 0:
+            continue
+        orig_idx = np.repeat(np.arange(i, i + len(neighbours)), counts)
+        dest_idx = np.concatenate([n for n in neighbours if n]).astype(int)
+        if upper:
+            is_upper = (orig_ids[orig_idx] < dest_ids[dest_idx]).astype(bool)
+            orig_idx = orig_idx[is_upper]
+            dest_idx = dest_idx[is_upper]
+
+        meters = haversineArray(orig_lon[orig_idx], orig_lat[orig_idx], dest_lon[dest_idx], dest_lat[dest_idx])
+        keep = meters < limit
+
+        db.executemany(insert_str, zip(orig_ids[orig_idx[keep]], dest_ids[dest_idx[keep]],
+            meters[keep].tolist()))
+        db.commit()
+        n_pairs += int(keep.sum())
+    return n_pairs
+
+
+def readPoints(db, source):
+    '''
+    Read the ids and coordinates (decimal degrees) of the orig or dest table
+    '''
+    rows = db.execute('SELECT {0}_id, {0}_lon, {0}_lat FROM {0}'.format(source)).fetchall()
+    ids = np.array([row[0] for row in rows], dtype=object)
+    lon = np.array([row[1] for row in rows], dtype=float)
+    lat = np.array([row[2] for row in rows], dtype=float)
+    return ids, lon, lat
+
+
+def unitSphere(lon, lat):
+    '''
+    Convert coordinates in decimal degrees to points on the unit sphere
+    '''
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    xyz = np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+    return xyz.reshape(-1, 3)
+
+
+def haversineArray(orig_lon, orig_lat, dest_lon, dest_lat):
+    '''
+    Vectorized haversine: the circle distance (rounded meters) between arrays of points
+    (decimal degrees), following numpy broadcasting.
+    The same steps as haversine, so the results are identical.
+    '''
+    orig_lon, orig_lat, dest_lon, dest_lat = map(np.radians, [orig_lon, orig_lat, dest_lon, dest_lat])
+
+    dlon = dest_lon - orig_lon
+    dlat = dest_lat - orig_lat
+    a = np.sin(dlat/2)**2 + np.cos(orig_lat) * np.cos(dest_lat) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
+
+    # 6367 km is the radius of the Earth
+    km = 6367 * c
+    m = km * 1000
+    return np.round(m).astype(np.int64)
+
+
 def haversine(orig_lon, orig_lat, dest_lon, dest_lat):
     '''
     Calculates the circle distance between two points 
@@ -0,0 +1,53 @@
+'''
+Handle failed OSRM requests: retries with exponential backoff, and a quarantine
+of the batches which still fail, to be replayed later (query_osrm --replay).
+'''
+import json
+import random
+import logging
+logger = logging.getLogger(__name__)
+
+# attempts per batch, including the first
+MAX_ATTEMPTS = 5
+# seconds before the first retry, doubling for every further one
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# seconds to wait for a response
+REQUEST_TIMEOUT = 300
+
+
+def Backoff(attempt):
+    '''
+    Seconds to wait after the failed attempt (0 for the first), with jitter
+    so that workers which failed together do not all retry together
+    '''
+    return min(MAX_BACKOFF, BACKOFF * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+def Retriable(status):
+    '''
+    Whether a request that failed with HTTP status (None for a connection error or timeout)
+    may succeed if tried again. Other errors (e.g. a point OSRM cannot snap) will not.
+    '''
+    return status is None or status >= 500 or status == 429
+
+
+def Quarantine(pair, writer, error):
+    '''
+    Record a batch which could not be queried in the quarantine table, via the writer
+    (database.WriteWorker). Its rows found in the cache are written now.
+    '''
+    logger.error('Quarantining the batch from origin {} ({} pairs): {!r}'.format(
+        pair.origs[0][0], len(Pairs(pair)), error))
+    if pair.cached:
+        writer.put(None, pair.cached)
+    writer.quarantine(pair.key, json.dumps(Pairs(pair)), repr(error))
+
+
+def Pairs(pair):
+    '''
+    The O-D pairs still to query in a batch
+    '''
+    if pair.pairs is None:
+        return [(o[0], d[0]) for o in pair.origs for d in pair.dests]
+    return sorted(pair.pairs)
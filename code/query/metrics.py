@@ -0,0 +1,128 @@
+'''
+Live metrics of the OSRM query stage, sampled every few seconds by a background thread:
+pairs and requests per second, request latency percentiles, the depth of the dispatch
+queues, the writer's backlog and lag, and the ETA.
+Each sample is logged and, if a file is given, appended to it as a line of JSON.
+'''
+import json
+import time
+import threading
+from threading import Thread
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+# seconds between samples
+INTERVAL = 10
+
+
+class QueryMetrics(Thread):
+    '''
+    The query workers report each request (Request); everything else is read from the
+    writer (database.WriteWorker) and the dispatch queues (queues, set by the engine of each mode)
+    when sampling.
+    '''
+    def __init__(self, n_pairs, writer, metrics_fn=None, interval=INTERVAL):
+        Thread.__init__(self)
+        self.daemon = True
+        self.n_pairs = n_pairs
+        self.writer = writer
+        self.metrics_fn = metrics_fn
+        self.interval = interval
+        self.queues = {}
+        self.latencies = []
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.start_time = time.time()
+        # time, pairs and requests at the last sample
+        self.last = (self.start_time, 0, 0)
+
+    def Request(self, seconds):
+        '''
+        Count a successful request which took seconds
+        '''
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+
+    def Close(self):
+        '''
+        Take a last sample and stop
+        '''
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        out = open(self.metrics_fn, 'a') if self.metrics_fn else None
+        try:
+            while not self.stopped.wait(self.interval):
+                self.Sample(out)
+            self.Sample(out)
+        finally:
+            if out:
+                out.close()
+
+    def Sample(self, out=None):
+        now = time.time()
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            requests = self.requests
+        pairs = self.writer.rows_received
+        last_time, last_pairs, last_requests = self.last
+        self.last = (now, pairs, requests)
+
+        interval = max(now - last_time, 1e-9)
+        overall = pairs / max(now - self.start_time, 1e-9)
+        percentiles = np.percentile(latencies, [50, 90, 99]) if latencies else [None] * 3
+        sample = {
+            'time' : round(now, 1),
+            'elapsed' : round(now - self.start_time, 1),
+            'pairs' : pairs,
+            'total_pairs' : self.n_pairs,
+            'pairs_per_sec' : round((pairs - last_pairs) / interval, 1),
+            'requests_per_sec' : round((requests - last_requests) / interval, 2),
+            'latency_p50' : Round(percentiles[0]),
+            'latency_p90' : Round(percentiles[1]),
+            'latency_p99' : Round(percentiles[2]),
+            'latency_max' : Round(max(latencies)) if latencies else None,
+            'queue_depth' : QueueDepth(list(self.queues.values())),
+            'writer_queue' : self.writer.queue.qsize(),
+            'writer_lag' : pairs - self.writer.rows_written,
+            'eta' : round(max(self.n_pairs - pairs, 0) / overall) if overall else None,
+            }
+        sample['bound'] = Bound(sample, self.writer.queue.maxsize)
+
+        logger.info(('{pairs}/{total_pairs} pairs, {pairs_per_sec} pairs/s, {requests_per_sec} requests/s, '
+            'latency p50/p90/p99 {latency_p50}/{latency_p90}/{latency_p99} s, queue {queue_depth}, '
+            'writer queue {writer_queue} (lag {writer_lag} pairs), ETA {eta} s, {bound}-bound').format(**sample))
+        if out:
+            out.write(json.dumps(sample) + '\n')
+            out.flush()
+        return sample
+
+
+def Bound(sample, writer_size):
+    '''
+    Guess what limits the run: a full writer queue means the disk ('writer'), an empty dispatch
+    queue means the batches are not produced fast enough ('client'), otherwise the 'server'
+    '''
+    if writer_size and sample['writer_queue'] >= 0.8 * writer_size:
+        return 'writer'
+    if sample['queue_depth'] == 0 and sample['pairs'] < sample['total_pairs']:
+        return 'client'
+    return 'server'
+
+
+def QueueDepth(queues):
+    '''
+    The total size of (threading, asyncio or multiprocessing) queues, if it can be told
+    '''
+    try:
+        return sum(queue.qsize() for queue in queues) if queues else None
+    except NotImplementedError:
+        return None
+
+
+def Round(seconds):
+    return None if seconds is None else round(float(seconds), 3)
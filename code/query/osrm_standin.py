@@ -0,0 +1,166 @@
+'''
+A lightweight stand-in for an OSRM server, for exercising and benchmarking the query
+stage without an OSRM install. It answers /table/v1/{profile} (and /nearest/v1/{profile})
+in OSRM's response format, with durations (and distances) from the haversine distance
+at a fixed speed, and a configurable latency, error rate, share of null durations
+and table size limit.
+'''
+# our functions
+import euclidean
+from table_request import COORDS, DecodePolyline
+# pip functions
+import argparse
+import json
+import random
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from urllib.parse import unquote, urlsplit, parse_qsl
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+# m/s, as OSRM's foot profile (5 km/h)
+SPEED = 5 / 3.6
+
+
+class StandIn():
+    '''
+    The behaviour of the stand-in server:
+        - latency: seconds per request, plus latency_per_cell per source x destination
+        - error_rate: share of requests answered with a 500 error
+        - null_rate: share of destinations without a route (a null duration), the same for
+          a coordinate on every request
+        - max_table_size: larger tables are rejected as TooBig, as osrm-routed --max-table-size
+    '''
+    def __init__(self, latency=0.0, latency_per_cell=0.0, error_rate=0.0, null_rate=0.0, max_table_size=None,
+            speed=SPEED, seed=None):
+        self.latency = latency
+        self.latency_per_cell = latency_per_cell
+        self.error_rate = error_rate
+        self.null_rate = null_rate
+        self.max_table_size = max_table_size
+        self.speed = speed
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    def Table(self, coords, query):
+        '''
+        The status and response of a /table request for coords (the part of the path after the profile)
+        '''
+        points = ParseCoords(coords)
+        sources = ParseIndices(query.get('sources'), len(points))
+        destinations = ParseIndices(query.get('destinations'), len(points))
+        if self.random.random() < self.error_rate:
+            return 500, {'code' : 'InternalError', 'message' : 'Simulated error'}
+        if self.max_table_size and len(sources) * len(destinations) > self.max_table_size ** 2:
+            return 400, {'code' : 'TooBig', 'message' : 'Too many table coordinates'}
+        time.sleep(self.latency + self.latency_per_cell * len(sources) * len(destinations))
+
+        lonlat = np.array(points, dtype=float).reshape(-1, 2)
+        meters = euclidean.haversineArray(lonlat[sources, 0][:, None], lonlat[sources, 1][:, None],
+            lonlat[destinations, 0], lonlat[destinations, 1]).tolist()
+        unroutable = [self.IsUnroutable(points[j]) for j in destinations]
+        response = {'code' : 'Ok',
+            'durations' : [[None if unroutable[k] else round(m / self.speed, 1) for k, m in enumerate(row)]
+                for row in meters],
+            'sources' : [Waypoint(points[i]) for i in sources],
+            'destinations' : [Waypoint(points[j]) for j in destinations]}
+        if 'distance' in query.get('annotations', ''):
+            response['distances'] = [[None if unroutable[k] else float(m) for k, m in enumerate(row)]
+                for row in meters]
+        return 200, response
+
+    def Nearest(self, coords):
+        '''
+        The status and response of a /nearest request: every point snaps to itself
+        '''
+        point = ParseCoords(coords)[0]
+        return 200, {'code' : 'Ok', 'waypoints' : [dict(Waypoint(point), distance=0.0)]}
+
+    def IsUnroutable(self, point):
+        return self.null_rate and zlib.crc32('{:.6f},{:.6f}'.format(*point).encode()) % 10 ** 6 < self.null_rate * 10 ** 6
+
+
+def ParseCoords(coords):
+    '''
+    The (lon, lat) points of the coordinates of a request: as text, or a polyline (see table_request.COORDS)
+    '''
+    coords = unquote(coords)
+    for name, precision in COORDS.items():
+        if precision and coords.startswith(name + '('):
+            return DecodePolyline(coords[len(name) + 1:-1], precision)
+    return [tuple(float(x) for x in point.split(',')) for point in coords.split(';')]
+
+
+def ParseIndices(indices, n_points):
+    if indices is None or indices == 'all':
+        return list(range(n_points))
+    return [int(i) for i in indices.split(';')]
+
+
+def Waypoint(point):
+    return {'location' : [round(point[0], 6), round(point[1], 6)], 'name' : '', 'hint' : ''}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and body are separate writes: with Nagle's algorithm, each response on a
+    # kept-alive connection would wait for the client's delayed ACK (about 40 ms)
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = url.path.split('/', 4)
+        try:
+            if len(parts) == 5 and parts[1] == 'table':
+                status, response = self.server.standin.Table(parts[4], dict(parse_qsl(url.query)))
+            elif len(parts) == 5 and parts[1] == 'nearest':
+                status, response = self.server.standin.Nearest(parts[4])
+            else:
+                status, response = 400, {'code' : 'InvalidUrl', 'message' : 'Unknown service'}
+        except (ValueError, IndexError) as e:
+            status, response = 400, {'code' : 'InvalidQuery', 'message' : str(e)}
+        self.server.standin.requests += 1
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def Serve(port, standin, background=False):
+    '''
+    Serve the stand-in on localhost:port (0 for any free port), in a daemon thread if background.
+    Returns the server, whose server_port is the port.
+    '''
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    server.daemon_threads = True
+    server.standin = standin
+    logger.info('OSRM stand-in on http://localhost:{}'.format(server.server_port))
+    if background:
+        Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Stand-in for an OSRM server (table and nearest services)')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per request')
+    parser.add_argument('--latency-per-cell', type=float, default=0.0, help='seconds per source x destination')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failing with a 500 error')
+    parser.add_argument('--null-rate', type=float, default=0.0, help='share of destinations without a route')
+    parser.add_argument('--max-table-size', type=int, help='as osrm-routed --max-table-size')
+    parser.add_argument('--speed', type=float, default=SPEED, help='m/s')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    Serve(args.port, StandIn(args.latency, args.latency_per_cell, args.error_rate, args.null_rate,
+        args.max_table_size, args.speed, args.seed))
@@ -0,0 +1,133 @@
+'''
+Plan which O-D pairs are sent to the OSRM server.
+Only pairs that can end up in the analysis need querying: subset_database keeps the pairs
+to destinations with services, with duration < max_dur.
+'''
+import sqlite3
+import batching
+import database
+import logging
+logger = logging.getLogger(__name__)
+
+# a fast walking speed (m/s), so that euclidean / MAX_WALK_SPEED is a lower bound on the
+# walking time (OSRM's foot profile walks at 5 km/h, about 1.4 m/s)
+MAX_WALK_SPEED = 2.0
+# rows fetched from the database at a time when streaming the plan
+CHUNK_SIZE = 10000
+
+
+def ServiceDestinations(service_db_fn):
+    '''
+    Get the dest_ids with services from the contracts table of a database (see shp2db)
+    '''
+    db = sqlite3.connect(service_db_fn)
+    dest_ids = [row[0] for row in db.execute('SELECT DISTINCT dest_id FROM contracts')]
+    db.close()
+    logger.info('Found {} service destinations in {}'.format(len(dest_ids), service_db_fn))
+    return dest_ids
+
+
+def PlanPairs(db, limit, dest_ids=None, max_dur=None, max_speed=MAX_WALK_SPEED, missing=None, upper=False):
+    '''
+    Create the temporary view plan_pairs (orig_id, dest_id, euclidean) of the pairs to query
+    on this connection, and plan_rows, the same pairs with their coordinates ordered by origin:
+        - euclidean < limit
+        - dest_id in dest_ids (if given)
+        - euclidean < max_speed * max_dur (if max_dur is given), as no slower pair
+          can have a duration < max_dur
+        - no result yet in the mode table named by missing (if given), or in any of
+          the mode tables if missing is a list (see WithoutResults)
+        - orig_id <= dest_id (if upper), for travel times taken as symmetric, whose
+          other half is written by mirroring (see symmetry.CheckSymmetry)
+    Log how many pairs (and one-origin requests) the plan saves.
+    '''
+    cursor = db.cursor()
+    CreateIndexes(cursor)
+    cursor.execute('DROP VIEW IF EXISTS temp.plan_rows')
+    cursor.execute('DROP VIEW IF EXISTS temp.plan_pairs')
+    cursor.execute('DROP TABLE IF EXISTS temp.plan_dest')
+
+    conditions = ['euclidean < {}'.format(float(limit))]
+    if dest_ids is not None:
+        cursor.execute('CREATE TEMP TABLE plan_dest(dest_id VARCHAR (15) PRIMARY KEY)')
+        cursor.executemany('INSERT OR IGNORE INTO plan_dest(dest_id) VALUES(?)', [(d,) for d in dest_ids])
+        conditions.append('dest_id IN (SELECT dest_id FROM temp.plan_dest)')
+    if max_dur is not None:
+        conditions.append('euclidean < {}'.format(float(max_speed * max_dur)))
+    if missing is not None:
+        missing = [missing] if isinstance(missing, str) else missing
+        for mode in missing:
+            cursor.execute('CREATE INDEX IF NOT EXISTS {0}_pair_idx ON {0}(orig_id, dest_id)'.format(mode))
+        conditions.append('({})'.format(' OR '.join('''NOT EXISTS (SELECT 1 FROM {0}
+            WHERE {0}.orig_id = origxdest.orig_id AND {0}.dest_id = origxdest.dest_id)'''.format(mode)
+            for mode in missing)))
+    if upper:
+        conditions.append('orig_id <= dest_id')
+
+    cursor.execute('''CREATE TEMP VIEW plan_pairs AS
+        SELECT orig_id, dest_id, euclidean FROM origxdest WHERE {}'''.format(' AND '.join(conditions)))
+    # the origxdest_orig_idx index gives the order without sorting
+    cursor.execute('''CREATE TEMP VIEW plan_rows AS
+        SELECT plan_pairs.orig_id, plan_pairs.dest_id, orig_lon, orig_lat, dest_lon, dest_lat FROM plan_pairs
+        INNER JOIN orig ON orig.orig_id = plan_pairs.orig_id
+        INNER JOIN dest ON dest.dest_id = plan_pairs.dest_id
+        ORDER BY plan_pairs.orig_id''')
+    db.commit()
+
+    if dest_ids is not None or max_dur is not None or missing is not None or upper:
+        all_pairs = CountPairs(cursor, 'origxdest WHERE euclidean < {}'.format(float(limit)))
+        planned = CountPairs(cursor, 'plan_pairs')
+        saved = 100 * (1 - planned[0] / all_pairs[0]) if all_pairs[0] else 0
+        logger.info('Plan: {} of {} pairs ({} of {} one-origin requests), {}% saved'.format(
+            planned[0], all_pairs[0], planned[1], all_pairs[1], round(saved, 1)))
+
+
+def CreateIndexes(cursor):
+    '''
+    Index the origins of the candidate pairs, and the points by id (covering their coordinates),
+    for streaming the plan. In a symmetric database (see database.InitSymmetric), both ends of
+    the pointxpoint pairs are indexed, as the origxdest view reads them both ways.
+    '''
+    if database.IsSymmetric(cursor):
+        cursor.execute('CREATE INDEX IF NOT EXISTS pointxpoint_orig_idx ON pointxpoint(orig_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS pointxpoint_dest_idx ON pointxpoint(dest_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS point_coords_idx ON point(point_id, point_lon, point_lat)')
+        return
+    cursor.execute('CREATE INDEX IF NOT EXISTS origxdest_orig_idx ON origxdest(orig_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS orig_coords_idx ON orig(orig_id, orig_lon, orig_lat)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS dest_coords_idx ON dest(dest_id, dest_lon, dest_lat)')
+
+
+def PlanRows(db, chunk_size=CHUNK_SIZE):
+    '''
+    Stream the rows (orig_id, dest_id, orig_lon, orig_lat, dest_lon, dest_lat) of the
+    plan_rows view, fetching chunk_size rows at a time. The rows of an origin are consecutive.
+    '''
+    cursor = db.cursor()
+    cursor.execute('SELECT * FROM plan_rows')
+    rows = cursor.fetchmany(chunk_size)
+    while rows:
+        yield from rows
+        rows = cursor.fetchmany(chunk_size)
+
+
+def WithoutResults(db, mode, batches):
+    '''
+    Take the pairs which already have a result in the mode table out of the batches,
+    for plans made with several missing modes, and drop the batches with none left
+    '''
+    result_str = 'SELECT dest_id FROM {} WHERE orig_id = ?'.format(mode)
+    for pair in batches:
+        done = set((orig_id, row[0]) for orig_id, orig_lon, orig_lat in pair.origs
+            for row in db.execute(result_str, (orig_id,)))
+        if done:
+            batching.Without(pair, done)
+        if pair.dests:
+            yield pair
+
+
+def CountPairs(cursor, source):
+    '''
+    Count the pairs and origins in source
+    '''
+    return cursor.execute('SELECT COUNT(*), COUNT(DISTINCT orig_id) FROM {}'.format(source)).fetchone()
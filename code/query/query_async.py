@@ -0,0 +1,332 @@
+'''
+Query the OSRM server with asyncio over a bounded pool of keep-alive connections.
+This is the 'async' engine of query_osrm.main - the number of requests in flight
+is set by concurrency rather than by the number of cores.
+Batches can be spread over several OSRM servers (endpoints), each with its own
+concurrency limit and health tracking, and optionally each driven from its own process.
+'''
+import asyncio
+import json
+import logging
+import multiprocessing
+import time
+from threading import Thread
+import aiohttp
+import batching
+import failures
+from table_request import TableURL, ParseRows
+logger = logging.getLogger(__name__)
+
+# seconds an idle connection is kept open for reuse
+KEEPALIVE_TIMEOUT = 60
+# consecutive failures before an endpoint is rested, and for how long (seconds)
+MAX_FAILURES = 3
+COOLDOWN = 30
+
+
+def Run(batches, endpoints, mode, writer, batcher, query_metrics, concurrency):
+    '''
+    Query every batch produced by the batches iterator,
+    passing the results to the writer (database.WriteWorker) and the
+    request latencies to the batcher (batching.AdaptiveBatcher) and query_metrics (metrics.QueryMetrics).
+    concurrency is the number of requests in flight per endpoint.
+    '''
+    asyncio.run(QueryAll(AsyncIter(batches), endpoints, mode, writer, batcher, query_metrics, concurrency))
+
+
+def RunProcesses(batches, endpoints, mode, writer, batcher, query_metrics, concurrency):
+    '''
+    As Run, but with one process per endpoint. The processes take batches from a shared
+    queue (so faster servers take more) and send their rows and latencies back to
+    the writer, batcher and query_metrics in this process.
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    in_queue = ctx.Queue(maxsize=4 * concurrency * len(endpoints))
+    query_metrics.queues[mode] = in_queue
+    out_queue = ctx.Queue(maxsize=4 * concurrency * len(endpoints))
+    processes = [ctx.Process(target=ProcessWorker,
+        args=(endpoint, mode, batcher.coords, batcher.distances,
+            {mode : batcher.hints[mode]} if mode in batcher.hints else {}, concurrency, in_queue, out_queue))
+        for endpoint in endpoints]
+    for process in processes:
+        process.start()
+
+    # forward the calls until every process has finished
+    targets = {'put' : writer, 'quarantine' : writer, 'Record' : batcher, 'Oversize' : batcher,
+        'Request' : query_metrics}
+    def Forward():
+        finished = 0
+        while finished < len(processes):
+            item = out_queue.get()
+            if item is None:
+                finished += 1
+            else:
+                getattr(targets[item[0]], item[0])(*item[1:])
+    forwarder = Thread(target=Forward)
+    forwarder.start()
+
+    for pair in batches:
+        in_queue.put(pair)
+    for process in processes:
+        in_queue.put(None)
+    forwarder.join()
+    for process in processes:
+        process.join()
+
+
+def ProcessWorker(endpoint, mode, coords, distances, hints, concurrency, in_queue, out_queue):
+    '''
+    Query the batches from in_queue against one endpoint, putting (key, rows) on out_queue
+    '''
+    logging.basicConfig(level=logging.INFO)
+    try:
+        proxy = QueueProxy(out_queue, coords, distances, hints)
+        asyncio.run(QueryAll(QueueIter(in_queue), [endpoint], mode, proxy, proxy, proxy, concurrency))
+    finally:
+        out_queue.put(None)
+
+
+class QueueProxy():
+    '''
+    Stands in for the writer, batcher and metrics in a worker process, passing the calls to the parent
+    '''
+    def __init__(self, out_queue, coords, distances, hints):
+        self.out_queue = out_queue
+        self.coords = coords
+        self.distances = distances
+        self.hints = hints
+        # the dispatch queues of the process, which the parent does not sample
+        self.queues = {}
+
+    def put(self, key, rows):
+        self.out_queue.put(('put', key, rows))
+
+    def quarantine(self, key, pairs, error):
+        self.out_queue.put(('quarantine', key, pairs, error))
+
+    def Record(self, cells, seconds):
+        self.out_queue.put(('Record', cells, seconds))
+
+    def Oversize(self, cells):
+        self.out_queue.put(('Oversize', cells))
+
+    def Request(self, seconds):
+        self.out_queue.put(('Request', seconds))
+
+
+async def AsyncIter(batches):
+    for pair in batches:
+        yield pair
+
+
+async def QueueIter(queue):
+    '''
+    Yield batches from a multiprocessing queue until the None sentinel, without blocking the loop
+    '''
+    loop = asyncio.get_running_loop()
+    pair = await loop.run_in_executor(None, queue.get)
+    while pair is not None:
+        yield pair
+        pair = await loop.run_in_executor(None, queue.get)
+
+
+class Endpoint():
+    '''
+    An OSRM server, e.g. http://localhost:5000, with its requests in flight and health
+    '''
+    def __init__(self, url, limit):
+        self.url = url.rstrip('/')
+        self.limit = limit
+        self.in_flight = 0
+        self.failures = 0
+        self.down_until = 0
+        self.requests = 0
+
+
+class EndpointPool():
+    '''
+    Hands out endpoints: the least loaded healthy endpoint with a free slot.
+    An endpoint that fails MAX_FAILURES times in a row is rested for COOLDOWN seconds,
+    unless it is the last healthy one.
+    '''
+    def __init__(self, urls, concurrency):
+        self.endpoints = [Endpoint(url, concurrency) for url in urls]
+        self.condition = asyncio.Condition()
+
+    async def Acquire(self, tried=()):
+        '''
+        Wait for an endpoint which is not in tried
+        '''
+        async with self.condition:
+            while True:
+                endpoint = Pick(self.endpoints, tried)
+                if endpoint:
+                    return endpoint
+                try:
+                    await asyncio.wait_for(self.condition.wait(), WaitTime(self.endpoints))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def Release(self, endpoint, ok):
+        async with self.condition:
+            Record(self.endpoints, endpoint, ok)
+            self.condition.notify_all()
+
+
+def Pick(endpoints, tried=()):
+    '''
+    Take a slot of the least loaded healthy endpoint with a free slot which is not in tried,
+    if there is one
+    '''
+    now = time.monotonic()
+    free = [e for e in endpoints if e.in_flight < e.limit and e.down_until <= now and e not in tried]
+    if not free:
+        return None
+    # ties (e.g. when idle) go to the endpoint with the fewest requests so far
+    endpoint = min(free, key=lambda e: (e.in_flight / e.limit, e.requests))
+    endpoint.in_flight += 1
+    return endpoint
+
+
+def WaitTime(endpoints):
+    '''
+    Seconds until a rested endpoint comes back (None if none is resting), the longest
+    to wait for a slot to be freed
+    '''
+    now = time.monotonic()
+    resting = [e.down_until for e in endpoints if e.down_until > now]
+    return min(resting) - now if resting else None
+
+
+def Record(endpoints, endpoint, ok):
+    '''
+    Free the slot of a request to endpoint, and rest the endpoint if it has failed
+    MAX_FAILURES times in a row (unless it is the last healthy one)
+    '''
+    endpoint.in_flight -= 1
+    endpoint.requests += 1
+    if ok:
+        endpoint.failures = 0
+        return
+    endpoint.failures += 1
+    now = time.monotonic()
+    others = [e for e in endpoints if e is not endpoint and e.down_until <= now]
+    if endpoint.failures >= MAX_FAILURES and others:
+        endpoint.down_until = now + COOLDOWN
+        endpoint.failures = 0
+        logger.warning('{} failed {} times in a row, resting it for {} seconds'.format(
+            endpoint.url, MAX_FAILURES, COOLDOWN))
+
+
+async def QueryAll(batches, endpoints, mode, writer, batcher, query_metrics, concurrency):
+    '''
+    Feed the batches (an async iterator) to worker coroutines which share one session.
+    The queue is bounded so that batches are only read from the database as fast as they are queried.
+    '''
+    pool = EndpointPool(endpoints, concurrency)
+    n_workers = concurrency * len(endpoints)
+    connector = aiohttp.TCPConnector(limit=n_workers, limit_per_host=concurrency,
+        keepalive_timeout=KEEPALIVE_TIMEOUT)
+    queue = asyncio.Queue(maxsize=2 * n_workers)
+    query_metrics.queues[mode] = queue
+
+    timeout = aiohttp.ClientTimeout(total=failures.REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        workers = [asyncio.ensure_future(QueryWorker(queue, session, pool, mode, writer, batcher, query_metrics))
+            for x in range(n_workers)]
+        async for pair in batches:
+            await queue.put(pair)
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    for endpoint in pool.endpoints:
+        logger.info('{}: {} requests'.format(endpoint.url, endpoint.requests))
+
+
+async def QueryWorker(queue, session, pool, mode, writer, batcher, query_metrics):
+    '''
+    A single coroutine, which executes querying tasks
+    '''
+    while True:
+        pair = await queue.get()
+        try:
+            await QueryBatch(pair, session, pool, mode, writer, batcher, query_metrics)
+        except Exception:
+            logger.exception('Query for batch from origin {} failed'.format(pair.origs[0][0]))
+        finally:
+            queue.task_done()
+
+
+async def QueryBatch(pair, session, pool, mode, writer, batcher, query_metrics):
+    '''
+    Query a batch, quarantining it (see failures.Quarantine) if it still fails after the retries.
+    A batch the server finds too big is split in two, and each half queried on its own.
+    '''
+    try:
+        halves = await QueryRetry(pair, session, pool, mode, writer, batcher, query_metrics)
+    except Exception as e:
+        await asyncio.get_running_loop().run_in_executor(None, failures.Quarantine, pair, writer, e)
+        return
+    for half in halves:
+        await QueryBatch(half, session, pool, mode, writer, batcher, query_metrics)
+
+
+async def QueryRetry(pair, session, pool, mode, writer, batcher, query_metrics):
+    '''
+    Query a batch, retrying a request which failed on the connection or the server
+    up to failures.MAX_ATTEMPTS times with exponential backoff.
+    Each retry goes to an endpoint which has not been tried yet, while there is one.
+    '''
+    tried = []
+    for attempt in range(failures.MAX_ATTEMPTS):
+        if len(tried) == len(pool.endpoints):
+            tried = []
+        endpoint = await pool.Acquire(tried)
+        tried.append(endpoint)
+        try:
+            halves = await QueryOSRM(pair, session, endpoint.url, mode, writer, batcher, query_metrics)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status = e.status if isinstance(e, aiohttp.ClientResponseError) else None
+            retry = failures.Retriable(status)
+            # an error the server reports for the batch is not the endpoint's fault
+            await pool.Release(endpoint, not retry)
+            if attempt == failures.MAX_ATTEMPTS - 1 or not retry:
+                raise
+            wait = failures.Backoff(attempt)
+            logger.warning('Query for batch from origin {} to {} failed ({!r}), retrying in {} seconds'.format(
+                pair.origs[0][0], endpoint.url, e, round(wait, 1)))
+            await asyncio.sleep(wait)
+        except Exception:
+            await pool.Release(endpoint, True)
+            raise
+        else:
+            await pool.Release(endpoint, True)
+            return halves
+
+
+async def QueryOSRM(pair, session, endpoint, mode, writer, batcher, query_metrics):
+    '''
+    Sends a query to an OSRM server on a pooled connection and passes the parsed response to the writer.
+    If the server finds the request too big, the two halves of the batch are returned
+    to be queried instead (an empty list otherwise).
+    '''
+    url = TableURL(pair, endpoint, mode, batcher.coords, batcher.distances, batcher.hints.get(mode))
+    start = time.monotonic()
+    async with session.get(url) as r:
+        text = await r.text()
+    if batching.IsOversize(r.status, text):
+        batcher.Oversize(batching.Cells(pair))
+        return batching.Split(pair)
+    r.raise_for_status()
+    batcher.Record(batching.Cells(pair), time.monotonic() - start)
+    query_metrics.Request(time.monotonic() - start)
+    response = json.loads(text)
+
+    # the writer's queue is bounded, so wait for it off the event loop
+    rows = ParseRows(pair, response)
+    await asyncio.get_running_loop().run_in_executor(None, writer.put, pair.key, rows)
+    if pair.completion:
+        logger.info("{} percent completed querying task".format(pair.completion))
+    return []
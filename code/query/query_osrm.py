@@ -1,9 +1,19 @@
 # our functions
 import database
 import euclidean
+import batching
+import failures
+import metrics
+import query_async
+import tiling
+import planner
+import snapping
+import symmetry
+from cache import TravelTimeCache
+from table_request import TableURL, ParseRows
 # pip functions
-import requests, csv, time, os.path, logging, multiprocessing, shapefile
-import heapq, threading
+import requests, time, os.path, logging, multiprocessing, shapefile, argparse
+import heapq, threading, copy
 from progressbar import ProgressBar, Percentage, Bar
 from queue import Queue
 import pandas as pd
@@ -44,95 +54,178 @@ handler.setFormatter(formatter)
 
 # add the handlers to the logger
 logger.addHandler(handler)
-
-
-def main(limit=5000, mode='walking', port=5000):
+logging.getLogger('metrics').addHandler(handler)
+
+
+# file names
+orig_fn = '../data/por_block/por_blocks.shp' 
+dest_fn = orig_fn
+db_fn = '../query_results/por_5km.db'
+db_temp_fn = '../query_results/por-temp_5km.db'
+cache_fn = '../query_results/osrm_cache.db'
+metrics_fn = 'osrm_query_metrics.jsonl'
+# batches waiting for each mode's engine when querying several modes
+MODE_QUEUE_SIZE = 100
+
+
+def main(limit=5000, mode='walking', port=5000, engine='threads', concurrency=32, tile=None,
+        resume=False, services=None, max_dur=None, incremental=False,
+        orig_fn=orig_fn, dest_fn=dest_fn, db_fn=db_fn, db_temp_fn=db_temp_fn, cache_fn=None, dataset='',
+        endpoints=None, processes=False, batch_size=batching.START_SIZE, adapt=True,
+        target_latency=batching.TARGET_LATENCY, max_table_size=batching.MAX_TABLE_SIZE,
+        max_url_length=batching.MAX_URL_LENGTH, coords='polyline6', replay=False,
+        metrics_fn=metrics_fn, metrics_interval=metrics.INTERVAL, distances=False, hints=False, resnap=False,
+        symmetric=False, mirror=None):
     '''
     Input:
         - Two shapefiles with coordinates and generates transit times between each pair.
+        - mode: the OSRM profile, or a list of them to query in one pass, each into its own
+          table: the pairs are planned and read once, and every batch is sent to each mode's endpoints
+        - engine: 'threads' (one QueryWorker thread per core) or 'async' (asyncio over
+          a pool of keep-alive connections, with concurrency requests in flight per endpoint)
+        - endpoints: OSRM servers to spread the batches over, e.g. ['http://localhost:5000',
+          'http://localhost:5001'] (default: localhost on port, and port + i for the i-th mode).
+          With several modes, 'MODE=URL' is a server for that mode only (see ModeEndpoints).
+          With either engine, each request goes to the least loaded healthy server, and a failed
+          request is retried on another one (see EndpointPool).
+        - distances: also get the network distance (meters) of each pair, from the same
+          requests (annotations=duration,distance), into the distance column of the mode table
+        - hints: snap the points once with /nearest (see snapping.Snap), flagging those which
+          snap far away, and send the hints with every request so the server does not snap them
+          again. Points snapped in earlier runs are kept, unless resnap (e.g. for a new extract).
+        - symmetric: the origins and destinations are the same points (orig_fn), stored once, with
+          the euclidean distance of each pair of points calculated once (see database.InitSymmetric)
+        - mirror: in a symmetric database, take the travel times as symmetric if a sample of
+          pairs queried both ways differs by at most mirror seconds (see symmetry.CheckSymmetry),
+          and only query each pair of points one way, writing the other way from it
+        - processes: with the async engine, drive each endpoint from its own process
+        - tile: (M, N) to query spatially grouped blocks of M origins x N destinations
+          per request, rather than one origin per request
+        - batch_size: destinations per one-origin request; with adapt, the starting size,
+          which is then set from the latency of the requests to reach target_latency seconds
+          (see batching.AdaptiveBatcher). Requests are kept within max_table_size
+          (osrm-routed --max-table-size) and max_url_length, and split if the server rejects them.
+        - coords: send the coordinates as 'text', or as a 'polyline' or 'polyline6' (5 or 6
+          decimal places), which makes the URLs several times shorter
+        - replay: only query the batches in the quarantine table, which failed in earlier
+          runs after their retries (see failures.Quarantine), keeping the existing results
+        - metrics_fn: file the query metrics (see metrics.QueryMetrics) are appended to,
+          every metrics_interval seconds, as well as being logged
+        - resume: keep the results of a previous (interrupted) run and only query the
+          pairs which are not in the mode table. Must select the same pairs (services, max_dur,
+          incremental and mirror), but may be batched differently.
+        - services: a database with a contracts table (see shp2db); only the pairs to
+          destinations with services are queried
+        - max_dur: skip pairs too far apart to be walked within max_dur seconds
+          (see planner.MAX_WALK_SPEED), as subset_database drops them. Walking modes only:
+          the bound would cut a faster mode's pairs short.
+        - incremental: add any new origins/destinations in the shapefiles to the existing
+          database and only query the pairs without a result, keeping the existing results
+        - cache_fn: a travel time cache (see cache.TravelTimeCache) shared between runs;
+          dataset names the OSRM extract, as cached times are only reused for the same one
     Output:
         - combined-data.db (SQL)
     '''
-    # shapefiles
-    orig_fn = '../data/por_block/por_blocks.shp' 
-    dest_fn = orig_fn
-    db_fn = '../query_results/por_5km.db'
-    temp_fn = '../query_results/por-temp_5km.csv'
-    db_temp_fn = '../query_results/por-temp_5km.db'
+    modes = [mode] if isinstance(mode, str) else list(mode)
+    mode_endpoints = ModeEndpoints(modes, endpoints, port)
+    if max_dur is not None and modes != ['walking'] * len(modes):
+        raise ValueError('max_dur bounds the pairs at walking speed (see planner.MAX_WALK_SPEED), '
+            'so it can only be used with the walking mode, not {}'.format(modes))
 
     # logger
-    logger.info("Started with limit {} meters and mode {} on port {}".format(limit, mode, port))
+    for mode in modes:
+        logger.info("Started with limit {} meters and mode {} on {} ({} engine)".format(limit, mode,
+            ', '.join(mode_endpoints[mode]), engine))
     start = time.time()
 
     #Check for raw data
-    CheckRawData(db_fn, orig_fn, dest_fn, temp_fn, db_temp_fn, mode)
+    if incremental:
+        UpdateRawData(db_fn, orig_fn, dest_fn, limit)
+    else:
+        CheckRawData(db_fn, orig_fn, dest_fn, db_temp_fn, modes[0], limit, symmetric)
+
+    batcher = batching.AdaptiveBatcher(tile[0] * tile[1] if tile else batch_size, adapt,
+        target_latency, max_table_size, max_url_length, coords=coords, distances=distances)
+    if hints:
+        for mode in modes:
+            snapping.Snap(db_fn, mode, mode_endpoints[mode], concurrency, resnap=resnap)
+            batcher.SetHints(mode, snapping.ReadHints(db_fn, mode))
 
     #Open connection to .db
     db = sqlite3.connect(db_fn) 
     cursor = db.cursor()
-
-    #Get length of data to process
-    BATCH_SIZE = 500
-    cursor.execute('''SELECT COUNT(*) FROM origxdest'''.format(float(limit))) 
-    data_len = cursor.fetchone()[0] / BATCH_SIZE
-    logger.info('Queries to execute: {}'.format(data_len))
-
-    #Query .db
-    cursor.execute('''SELECT origxdest.orig_id, origxdest.dest_id, orig_lon, orig_lat, 
-        dest_lon, dest_lat FROM origxdest
-        INNER JOIN orig ON orig.orig_id = origxdest.orig_id
-        INNER JOIN dest ON dest.dest_id = origxdest.dest_id
-        WHERE euclidean < {}'''.format(limit))
-
-    #Set multiprocessing
-    no_cores = multiprocessing.cpu_count()
-    if no_cores <= 10:
-        no_cores -= 2
-    else:
-        no_cores -= 4
-
-    #Form queue of workers
-    queue = Queue()
-    for x in range(no_cores):
-        worker = QueryWorker(queue, port, mode, temp_fn)
-        worker.daemon = True
-        worker.start()
-
-    #Calculate milestones for display
-    percentages = {}
-    for i in range(1, 20):
-        actual = round(data_len * i / 20)
-        percentages[actual] = round(i / 20 * 100)
+    dest_ids = planner.ServiceDestinations(services) if services and not replay else None
+    if mirror is not None and not replay:
+        mirror = Mirror(db, limit, dest_ids, max_dur, modes, mode_endpoints, batcher, mirror)
+
+    # the pairs the run queries: a run is resumed from the rows written, so the batching can change
+    plan = 'pairs'
+    if services or max_dur:
+        plan += '-services{}'.format(max_dur or '')
+    if incremental:
+        plan += '-incremental'
+    if mirror:
+        plan += '-mirror'
+    for mode in modes:
+        database.InitResults(db_fn, mode, distances)
+        if not replay:
+            # a run is resumed from the rows written rather than from batch keys: adaptive
+            # batches differ between runs, and any batch may have been split in parts which
+            # were not all written (see batching.Split)
+            database.InitCheckpoint(db_fn, mode, plan, resume, keep_results=incremental)
+
+    # results are streamed into the mode tables (and cache) while querying
+    caches = {mode : TravelTimeCache(cache_fn, mode, dataset, distances=distances) for mode in modes} if cache_fn else {}
+    writer = database.WriteWorker(db_fn, modes, plan, caches=caches, checkpoint=False, distances=distances,
+        mirror=bool(mirror))
+    writer.start()
+
+    if not replay:
+        #Plan the pairs to query
+        missing = modes if incremental or resume else None
+        planner.PlanPairs(db, limit, dest_ids, max_dur, missing=missing, upper=bool(mirror))
+
+        #Get length of data to process
+        cursor.execute('''SELECT COUNT(*) FROM plan_pairs''') 
+        n_pairs = cursor.fetchone()[0]
+        logger.info('Pairs to query: {}'.format(n_pairs))
 
     query_start = time.time()
-    #Add workers to queue (multiprocessing)
     logger.info('Started querying OSRM server')
-    data = cursor.fetchone()
-    dests = []
-    prev_orig_id = ''
-    prev_orig_lon = ''
-    prev_orig_lat = ''
-    counter = 0
-    while data:
-        dests.append((data[1], data[4], data[5]))
-        if (counter % BATCH_SIZE == 0 or prev_orig_id != data[0]) and counter != 0:
-            pair = OrigxMany(data[0], data[2], data[3], dests, percentages)
-            queue.put(pair)
-            dests = []
-        prev_orig_id = data[0]
-        prev_orig_lon = data[2]
-        prev_orig_lat = data[3]
-        counter += 1
-        data = cursor.fetchone()
+    if replay:
+        n_pairs = sum(len(pairs) for mode in modes for key, pairs in database.ReadQuarantine(db, mode))
+    else:
+        n_pairs *= len(modes)
+    query_metrics = metrics.QueryMetrics(n_pairs, writer, metrics_fn, metrics_interval)
+    query_metrics.start()
+    engine_args = (engine, processes, concurrency, batcher, query_metrics)
+    if replay:
+        # each mode has its own quarantine, so the modes are replayed in turn
+        for mode in modes:
+            # through the cache too, which records the coordinates of the pairs it is given
+            batches = ModeBatches(QuarantinedBatches(db, mode, writer.Mode(mode)), mode, caches.get(mode),
+                writer.Mode(mode))
+            QueryMode(batches, mode, mode_endpoints[mode], writer.Mode(mode), *engine_args)
+    else:
+        if tile:
+            batches = tiling.Tiles(db, tile[0], batcher)
+        else:
+            batches = Batches(planner.PlanRows(db), batcher, n_pairs // len(modes))
+        # with several modes, the plan has the pairs missing from any of the mode tables
+        results_db = db if missing and len(modes) > 1 else None
+        if len(modes) == 1:
+            QueryMode(ModeBatches(batches, modes[0], caches.get(modes[0]), writer.Mode(modes[0])),
+                modes[0], mode_endpoints[modes[0]], writer.Mode(modes[0]), *engine_args)
+        else:
+            QueryModes(batches, modes, mode_endpoints, caches, writer, results_db, engine_args)
     db.close()
-    queue.join()
+    writer.close()
+    query_metrics.Close()
+    for cache in caches.values():
+        cache.Close()
     query_end = time.time()
     logger.info('Done querying OSRM server ({} seconds)'.format(query_end - query_start))
 
-    #transfer to .db
-    database.Write(mode, temp_fn, db_fn)
-
-
     #show timer
     end = time.time()
     secs = round(end - start,2)
@@ -145,94 +238,425 @@ def main(limit=5000, mode='walking', port=5000):
 
 
     
-def CheckRawData(db_fn, orig_fn, dest_fn, temp_fn, db_temp_fn, mode):
+def CheckRawData(db_fn, orig_fn, dest_fn, db_temp_fn, mode, limit, symmetric=False):
     '''
     check that data doesn't exist already
-    if not, init database
+    if not, init database (origxdest only holds the pairs within limit),
+    with a single point table, from orig_fn, if symmetric (see database.InitSymmetric)
     '''
     if not os.path.isfile(db_fn):
-        database.Init(db_fn, orig_fn, dest_fn, db_temp_fn)
-        euclidean.calculate(mode, db_fn, db_temp_fn)
+        database.Init(db_fn, orig_fn, dest_fn, db_temp_fn, symmetric)
+        euclidean.calculate(mode, db_fn, db_temp_fn, limit, symmetric=symmetric)
     else:
         logger.info('Found combined-data.db')
-    if os.path.isfile(temp_fn):
-        os.remove(temp_fn)
-        logger.info('Deleting old temp data')
 
-    with open(temp_fn, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['0','1','2'])
+
+def Mirror(db, limit, dest_ids, max_dur, modes, mode_endpoints, batcher, tolerance):
+    '''
+    Whether each pair of points can be queried one way only: the database is symmetric and
+    every mode is symmetric within tolerance seconds on a sample of the planned pairs
+    '''
+    if not database.IsSymmetric(db):
+        raise ValueError('Mirroring travel times needs a symmetric database (see database.InitSymmetric)')
+    if dest_ids is not None:
+        logger.warning('Only the pairs to services are planned, so few are mirrored: querying both ways')
+        return False
+    planner.PlanPairs(db, limit, None, max_dur)
+    return all([symmetry.CheckSymmetry(db, mode, mode_endpoints[mode][0], batcher, tolerance) for mode in modes])
+
+
+def UpdateRawData(db_fn, orig_fn, dest_fn, limit):
+    '''
+    add the new origins and destinations to an existing database,
+    with the euclidean distances of their pairs
+    '''
+    if not os.path.isfile(db_fn):
+        raise FileNotFoundError('Incremental mode needs an existing {}'.format(db_fn))
+    new_origs, new_dests = database.Update(db_fn, orig_fn, dest_fn)
+    if new_origs or new_dests:
+        euclidean.calculateNew(db_fn, limit, new_origs, new_dests)
+
+
+def ModeEndpoints(modes, endpoints, port):
+    '''
+    The OSRM servers of each mode: endpoints are URLs, for every mode, or 'MODE=URL'
+    for one mode only. Without endpoints, the i-th mode is on localhost at port + i.
+    '''
+    if not endpoints:
+        return {mode : ['http://localhost:{}'.format(port + i)] for i, mode in enumerate(modes)}
+    mode_endpoints = {mode : [] for mode in modes}
+    for endpoint in endpoints:
+        name, sep, url = endpoint.partition('=')
+        if sep and '/' not in name:
+            if name not in mode_endpoints:
+                raise ValueError('Endpoint {} is for mode {}, which is not queried'.format(url, name))
+            mode_endpoints[name].append(url)
+        else:
+            for mode in modes:
+                mode_endpoints[mode].append(endpoint)
+    for mode in modes:
+        if not mode_endpoints[mode]:
+            raise ValueError('No endpoint for mode {}'.format(mode))
+    return mode_endpoints
+
+
+def ModeBatches(batches, mode, cache, writer, results_db=None):
+    '''
+    The batches left to query for a mode: without the pairs in its table (if results_db
+    is given, see planner.WithoutResults) and the pairs in its cache
+    '''
+    if results_db:
+        batches = planner.WithoutResults(results_db, mode, batches)
+    if cache:
+        batches = cache.Filter(batches, writer)
+    return batches
+
+
+def QueryMode(batches, mode, endpoints, writer, engine, processes, concurrency, batcher, query_metrics):
+    '''
+    Query the batches of a mode with the engine
+    '''
+    if engine == 'async' and processes:
+        query_async.RunProcesses(batches, endpoints, mode, writer, batcher, query_metrics, concurrency)
+    elif engine == 'async':
+        query_async.Run(batches, endpoints, mode, writer, batcher, query_metrics, concurrency)
+    else:
+        QueryThreaded(batches, endpoints, mode, writer, batcher, query_metrics)
+
+
+def QueryModes(batches, modes, mode_endpoints, caches, writer, results_db, engine_args):
+    '''
+    Query every batch for each of the modes. The batches are read once, here, and a copy
+    of each is filtered for every mode (see ModeBatches) and queued for the mode's engine,
+    which runs in its own thread.
+    '''
+    queues = {mode : Queue(MODE_QUEUE_SIZE) for mode in modes}
+    threads = [Thread(target=QueryModeQueue, args=(queues[mode], mode, mode_endpoints[mode],
+        writer.Mode(mode)) + engine_args) for mode in modes]
+    for thread in threads:
+        thread.start()
+    try:
+        for pair in batches:
+            for i, mode in enumerate(modes):
+                mode_pair = copy.copy(pair)
+                if i > 0:
+                    # completion is reported once per batch
+                    mode_pair.completion = None
+                for mode_pair in ModeBatches([mode_pair], mode, caches.get(mode),
+                        writer.Mode(mode), results_db):
+                    queues[mode].put(mode_pair)
+    finally:
+        for mode in modes:
+            queues[mode].put(None)
+        for thread in threads:
+            thread.join()
+
+
+def QueryModeQueue(queue, mode, endpoints, writer, *engine_args):
+    '''
+    Query the batches from queue until the None sentinel (see QueryModes)
+    '''
+    try:
+        QueryMode(iter(queue.get, None), mode, endpoints, writer, *engine_args)
+    except Exception:
+        logger.exception('Querying mode {} failed'.format(mode))
+        # keep draining so the other modes are not blocked
+        while queue.get() is not None:
+            pass
+
+
+def QueryThreaded(batches, endpoints, mode, writer, batcher, query_metrics):
+    '''
+    Query the batches with a pool of QueryWorker threads, which share the endpoints (see EndpointPool)
+    '''
+    #Set multiprocessing
+    no_cores = multiprocessing.cpu_count()
+    if no_cores <= 10:
+        no_cores -= 2
+    else:
+        no_cores -= 4
+    # at least one worker per endpoint, or nothing would take the batches off the queue
+    no_cores = max(no_cores, len(endpoints))
+
+    #Form queue of workers
+    queue = Queue()
+    query_metrics.queues[mode] = queue
+    # any endpoint may take every worker's request, when the others are resting
+    pool = EndpointPool(endpoints, no_cores)
+    for x in range(no_cores):
+        worker = QueryWorker(queue, pool, mode, writer, batcher, query_metrics)
+        worker.daemon = True
+        worker.start()
+
+    #Add workers to queue (multiprocessing)
+    for pair in batches:
+        queue.put(pair)
+    queue.join()
+    for endpoint in pool.endpoints:
+        logger.info('{}: {} requests'.format(endpoint.url, endpoint.requests))
+
+
+class EndpointPool():
+    '''
+    The endpoints of the threads engine, shared by its workers as query_async.EndpointPool:
+    each request goes to the least loaded healthy endpoint, and an endpoint that keeps
+    failing is rested for a while
+    '''
+    def __init__(self, urls, limit):
+        self.endpoints = [query_async.Endpoint(url, limit) for url in urls]
+        self.condition = threading.Condition()
+
+    def Acquire(self, tried=()):
+        '''
+        Wait for an endpoint which is not in tried
+        '''
+        with self.condition:
+            endpoint = query_async.Pick(self.endpoints, tried)
+            while endpoint is None:
+                self.condition.wait(query_async.WaitTime(self.endpoints))
+                endpoint = query_async.Pick(self.endpoints, tried)
+            return endpoint
+
+    def Release(self, endpoint, ok):
+        with self.condition:
+            query_async.Record(self.endpoints, endpoint, ok)
+            self.condition.notify_all()
+
+
+def Batches(rows, batcher, n_pairs):
+    '''
+    Group the O-D pairs from rows (see planner.PlanRows) into OrigxMany batches, each with a
+    single origin and as many destinations as the batcher (batching.AdaptiveBatcher) allows.
+    Rows are expected to arrive grouped by origin.
+    '''
+    # completion is reported at every 5% of the n_pairs
+    milestones = [(round(n_pairs * i / 20), round(i / 20 * 100)) for i in range(1, 20)]
+    n_batched = 0
+    dests = []
+    prev_orig = None
+    for data in rows:
+        orig = (data[0], data[2], data[3])
+        dest_length = batcher.CoordLength(len(dests) + 1, data[4], data[5])
+        if dests and (prev_orig[0] != orig[0] or len(dests) >= size
+                or not batcher.Fits(url_length + dest_length)):
+            n_batched += len(dests)
+            yield OrigxMany(prev_orig[0], prev_orig[1], prev_orig[2], dests, tiling.Completion(milestones, n_batched))
+            dests = []
+        if not dests:
+            size = batcher.Size()
+            url_length = batcher.CoordLength(0, orig[1], orig[2])
+            dest_length = batcher.CoordLength(1, data[4], data[5])
+        dests.append((data[1], data[4], data[5]))
+        url_length += dest_length
+        prev_orig = orig
+    if dests:
+        n_batched += len(dests)
+        yield OrigxMany(prev_orig[0], prev_orig[1], prev_orig[2], dests, tiling.Completion(milestones, n_batched))
+
+
+def QuarantinedBatches(db, mode, writer):
+    '''
+    Rebuild the batches in the quarantine table as tiles with their original keys,
+    leaving out the pairs which have a result by now
+    '''
+    origs = {row[0] : row for row in db.execute('SELECT orig_id, orig_lon, orig_lat FROM orig')}
+    dests = {row[0] : row for row in db.execute('SELECT dest_id, dest_lon, dest_lat FROM dest')}
+    db.execute('CREATE INDEX IF NOT EXISTS {0}_pair_idx ON {0}(orig_id, dest_id)'.format(mode))
+    result_str = 'SELECT 1 FROM {} WHERE orig_id = ? AND dest_id = ?'.format(mode)
+
+    quarantined = database.ReadQuarantine(db, mode)
+    logger.info('Replaying {} quarantined batches'.format(len(quarantined)))
+    for key, pairs in quarantined:
+        pairs = set(p for p in pairs if db.execute(result_str, p).fetchone() is None)
+        if not pairs:
+            # nothing left to query: take it out of the quarantine
+            writer.put(key, [])
+            continue
+        tile = tiling.OrigxDestTile([origs[o] for o in sorted(set(p[0] for p in pairs))],
+            [dests[d] for d in sorted(set(p[1] for p in pairs))], pairs)
+        tile.key = key
+        yield tile
+
 
 class OrigxMany():
     '''
     Data structure containing the data for a single query to the OSRM server.
     '''
-    id_ = 0
-    def __init__(self, orig_id, orig_lon, orig_lat, dests, percentages):
-        if OrigxMany.id_ in percentages:
-            self.completion = percentages[OrigxMany.id_]
-        else:
-            self.completion = None
+    def __init__(self, orig_id, orig_lon, orig_lat, dests, completion=None):
+        self.completion = completion
         self.orig_id = orig_id
         self.dests = dests
         self.orig_lon = orig_lon
         self.orig_lat = orig_lat
-        OrigxMany.id_ += 1
+        # every destination in the batch is a candidate pair
+        self.origs = [(orig_id, orig_lon, orig_lat)]
+        self.pairs = None
+        # rows found in the cache (see cache.TravelTimeCache)
+        self.cached = []
+        # the polyline of the destinations (see table_request.PolylineCoords)
+        self.encoded = None
+        self.key = '{}:{}'.format(orig_id, dests[0][0])
 
 
 class QueryWorker(Thread):
     '''
     A single thread, which executes querying tasks.
     '''
-    def __init__(self, queue, port, mode, temp_fn):
+    def __init__(self, queue, pool, mode, writer, batcher, query_metrics):
        Thread.__init__(self)
        self.queue = queue
-       self.port = port
+       self.pool = pool
        self.mode = mode
        self.qsize = self.queue.qsize()
-       self.temp_fn = temp_fn
+       self.writer = writer
+       self.batcher = batcher
+       self.query_metrics = query_metrics
 
     def run(self):
         while True:
             pair = self.queue.get()
-            QueryOSRM(pair, self.port, self.mode, self.temp_fn)
-            self.queue.task_done()
+            try:
+                QueryBatch(pair, self.pool, self.mode, self.writer, self.batcher, self.query_metrics)
+            except Exception:
+                logger.exception('Query for batch from origin {} failed'.format(pair.origs[0][0]))
+            finally:
+                self.queue.task_done()
 
 
-def QueryOSRM(pair, port, mode, temp_fn):
+def QueryBatch(pair, pool, mode, writer, batcher, query_metrics):
     '''
-    Sends a query to a local OSRM server. Expects a JSON as a response,
-    which this function then parses and writes to file
+    Query a batch, quarantining it (see failures.Quarantine) if it still fails after the retries.
+    A batch the server finds too big is split in two, and each half queried on its own.
     '''
-    #Form and parse server request
-    base_query = 'http://localhost:{}/table/v1/{}/{},{}'.format(port,mode,pair.orig_lon,pair.orig_lat)
-    mid_query = ''
-    end_query = '?sources=0'
-
-    for i, dest_data in enumerate(pair.dests):
-        dest_id, dest_lon, dest_lat = dest_data
-        mid_query += ';' + str(dest_lon) + ',' + str(dest_lat)
+    try:
+        halves = QueryRetry(pair, pool, mode, writer, batcher, query_metrics)
+    except Exception as e:
+        failures.Quarantine(pair, writer, e)
+        return
+    for half in halves:
+        QueryBatch(half, pool, mode, writer, batcher, query_metrics)
 
 
-    url = base_query + mid_query + end_query
-    r = requests.get(url)
+def QueryRetry(pair, pool, mode, writer, batcher, query_metrics):
+    '''
+    Query a batch, retrying a request which failed on the connection or the server
+    up to failures.MAX_ATTEMPTS times with exponential backoff.
+    Each retry goes to an endpoint which has not been tried yet, while there is one.
+    '''
+    tried = []
+    for attempt in range(failures.MAX_ATTEMPTS):
+        if len(tried) == len(pool.endpoints):
+            tried = []
+        endpoint = pool.Acquire(tried)
+        tried.append(endpoint)
+        try:
+            halves = QueryOSRM(pair, endpoint.url, mode, writer, batcher, query_metrics)
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            status = e.response.status_code if e.response is not None else None
+            retry = failures.Retriable(status)
+            # an error the server reports for the batch is not the endpoint's fault
+            pool.Release(endpoint, not retry)
+            if attempt == failures.MAX_ATTEMPTS - 1 or not retry:
+                raise
+            wait = failures.Backoff(attempt)
+            logger.warning('Query for batch from origin {} to {} failed ({!r}), retrying in {} seconds'.format(
+                pair.origs[0][0], endpoint.url, e, round(wait, 1)))
+            time.sleep(wait)
+        except Exception:
+            pool.Release(endpoint, True)
+            raise
+        else:
+            pool.Release(endpoint, True)
+            return halves
 
-    res = r.json()['durations'][0][1:]
 
-    with open(temp_fn, 'a', newline='') as f:
-        writer = csv.writer(f)
-        for i, dest_data in enumerate(pair.dests):
-            dest_id, dest_lon, dest_lat = dest_data
-            fields = [pair.orig_id, dest_id, int(res[i])]
-  
-            writer.writerow(fields)
+def QueryOSRM(pair, endpoint, mode, writer, batcher, query_metrics):
+    '''
+    Sends a query to an OSRM server. Expects a JSON as a response,
+    which this function then parses and passes to the writer.
+    If the server finds the request too big, the two halves of the batch are returned
+    to be queried instead (an empty list otherwise).
+    '''
+    url = TableURL(pair, endpoint, mode, batcher.coords, batcher.distances, batcher.hints.get(mode))
+    start = time.time()
+    r = requests.get(url, timeout=failures.REQUEST_TIMEOUT)
+    if batching.IsOversize(r.status_code, r.text):
+        batcher.Oversize(batching.Cells(pair))
+        return batching.Split(pair)
+    r.raise_for_status()
+    batcher.Record(batching.Cells(pair), time.time() - start)
+    query_metrics.Request(time.time() - start)
+
+    writer.put(pair.key, ParseRows(pair, r.json()))
     if pair.completion:
         logger.info("{} percent completed querying task".format(pair.completion))   
+    return []
 
     
 
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query an OSRM server for the travel time between O-D pairs')
+    parser.add_argument('--limit', type=int, default=5000, help='euclidean distance limit (meters)')
+    parser.add_argument('--mode', nargs='+', default=['walking'],
+        help='OSRM profiles to query, each into its own table')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--endpoints', nargs='+', metavar='URL',
+        help='OSRM servers to spread the queries over (instead of localhost on --port), as URL or MODE=URL')
+    parser.add_argument('--distances', action='store_true',
+        help='also store the network distance of each pair, from the same requests')
+    parser.add_argument('--hints', action='store_true',
+        help='snap the points once with /nearest and send the hints with each request')
+    parser.add_argument('--resnap', action='store_true', help='with --hints, snap every point again')
+    parser.add_argument('--symmetric', action='store_true',
+        help='the origins are also the destinations (--orig): store the points and their distances once')
+    parser.add_argument('--mirror', type=float, nargs='?', const=symmetry.TOLERANCE, metavar='TOLERANCE',
+        help='in a symmetric database, query each pair of points one way if the times are symmetric '
+        'within TOLERANCE seconds (default {})'.format(symmetry.TOLERANCE))
+    parser.add_argument('--processes', action='store_true', help='one process per endpoint (async engine)')
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads')
+    parser.add_argument('--concurrency', type=int, default=32, help='requests in flight per endpoint (async engine)')
+    parser.add_argument('--tile', type=int, nargs=2, metavar=('M', 'N'),
+        help='query blocks of M origins x N destinations per request')
+    parser.add_argument('--batch-size', type=int, default=batching.START_SIZE,
+        help='destinations per one-origin request (the starting size, unless --fixed-size)')
+    parser.add_argument('--fixed-size', action='store_true',
+        help='keep the batch (or tile) size rather than adapting it to the request latency')
+    parser.add_argument('--target-latency', type=float, default=batching.TARGET_LATENCY,
+        help='seconds per request the adaptive batch size aims for')
+    parser.add_argument('--max-table-size', type=int, default=batching.MAX_TABLE_SIZE,
+        help='the --max-table-size of the OSRM servers')
+    parser.add_argument('--max-url-length', type=int, default=batching.MAX_URL_LENGTH)
+    parser.add_argument('--replay', action='store_true',
+        help='query the batches which failed in earlier runs, from the quarantine table')
+    parser.add_argument('--metrics', default=metrics_fn, help='file to append the query metrics to')
+    parser.add_argument('--metrics-interval', type=float, default=metrics.INTERVAL,
+        help='seconds between metrics samples')
+    parser.add_argument('--coords', choices=['text', 'polyline', 'polyline6'], default='polyline6',
+        help='how the coordinates are sent to the OSRM server')
+    parser.add_argument('--resume', action='store_true',
+        help='continue an interrupted run, querying the pairs it has no result for')
+    parser.add_argument('--services', help='database with a contracts table: only query pairs to services')
+    parser.add_argument('--max-dur', type=int,
+        help='skip pairs that cannot be walked within this many seconds (walking mode only)')
+    parser.add_argument('--incremental', action='store_true',
+        help='add new points to the existing database and only query pairs without a result')
+    parser.add_argument('--orig', default=orig_fn, help='origin shapefile')
+    parser.add_argument('--dest', default=dest_fn, help='destination shapefile')
+    parser.add_argument('--db', default=db_fn, help='output database')
+    parser.add_argument('--db-temp', default=db_temp_fn)
+    parser.add_argument('--cache', nargs='?', const=cache_fn,
+        help='reuse travel times from (and add them to) this cache, {} if no file is given'.format(cache_fn))
+    parser.add_argument('--dataset', default='', help='name of the OSRM extract, for the cache')
+    args = parser.parse_args()
     logger.info("Running in main mode")
-    main()
+    main(limit=args.limit, mode=args.mode, port=args.port, engine=args.engine, concurrency=args.concurrency,
+        tile=args.tile, resume=args.resume, services=args.services, max_dur=args.max_dur,
+        incremental=args.incremental, orig_fn=args.orig, dest_fn=args.dest, db_fn=args.db,
+        db_temp_fn=args.db_temp, cache_fn=args.cache, dataset=args.dataset, endpoints=args.endpoints,
+        processes=args.processes, batch_size=args.batch_size, adapt=not args.fixed_size,
+        target_latency=args.target_latency, max_table_size=args.max_table_size,
+        max_url_length=args.max_url_length, coords=args.coords, replay=args.replay, metrics_fn=args.metrics,
+        metrics_interval=args.metrics_interval, distances=args.distances, hints=args.hints,
+        resnap=args.resnap, symmetric=args.symmetric, mirror=args.mirror)
@@ -0,0 +1,122 @@
+'''
+Snap the origins and destinations to the road network once, with OSRM's /nearest service,
+and keep the hint it returns for each point, so that /table requests can send the hints
+rather than have the server snap every coordinate of every request again.
+The snapped location and distance are kept too: points which snap far from where they are
+(e.g. a centroid in a park or on water) are flagged before the main run.
+'''
+import asyncio
+import sqlite3
+import time
+import aiohttp
+import failures
+import logging
+logger = logging.getLogger(__name__)
+
+# meters: points which snap further than this are flagged
+MAX_SNAP_DISTANCE = 250
+# points snapped (and written) at a time
+CHUNK_SIZE = 1000
+
+
+def InitSnap(db, mode, resnap=False):
+    '''
+    Create the table of the snapped points of a mode (unless resnap, keeping any from earlier runs).
+    The hint is NULL for a point the server could not snap.
+    '''
+    if resnap:
+        db.execute('DROP TABLE IF EXISTS {}_snap'.format(mode))
+    db.execute('''CREATE TABLE IF NOT EXISTS {}_snap(source VARCHAR (4), point_id VARCHAR (20), hint TEXT,
+        snap_lon REAL, snap_lat REAL, snap_distance REAL, PRIMARY KEY(source, point_id))'''.format(mode))
+    db.commit()
+
+
+def Snap(db_fn, mode, endpoints, concurrency=32, max_snap_distance=MAX_SNAP_DISTANCE, resnap=False):
+    '''
+    Snap the orig and dest points which are not in the mode's snap table yet, spreading the
+    /nearest requests over the endpoints, and log the points which snap further than max_snap_distance.
+    The hints are only valid for the OSRM dataset they came from: resnap after changing it.
+    '''
+    start = time.time()
+    db = sqlite3.connect(db_fn)
+    InitSnap(db, mode, resnap)
+    insert_str = '''INSERT OR REPLACE INTO {}_snap(source, point_id, hint, snap_lon, snap_lat, snap_distance)
+        VALUES (?, ?, ?, ?, ?, ?)'''.format(mode)
+    n_points = 0
+    for source in ['orig', 'dest']:
+        points = db.execute('''SELECT {0}_id, {0}_lon, {0}_lat FROM {0} WHERE {0}_id NOT IN
+            (SELECT point_id FROM {1}_snap WHERE source = ?)'''.format(source, mode), (source,)).fetchall()
+        for i in range(0, len(points), CHUNK_SIZE):
+            chunk = points[i:i + CHUNK_SIZE]
+            snapped = asyncio.run(SnapAll(chunk, endpoints, mode, concurrency))
+            db.executemany(insert_str, [(source, point[0]) + tuple(s) for point, s in zip(chunk, snapped)])
+            db.commit()
+        n_points += len(points)
+    logger.info('Snapped {} points for {} ({} seconds)'.format(n_points, mode, round(time.time() - start, 1)))
+    FlagSnaps(db, mode, max_snap_distance)
+    db.close()
+
+
+def FlagSnaps(db, mode, max_snap_distance=MAX_SNAP_DISTANCE):
+    '''
+    Log the points which could not be snapped or snap further than max_snap_distance, and return them
+    as (source, point_id, snap_distance), furthest first
+    '''
+    flagged = db.execute('''SELECT source, point_id, snap_distance FROM {}_snap
+        WHERE hint IS NULL OR snap_distance > ? ORDER BY snap_distance IS NULL DESC, snap_distance DESC'''.format(mode),
+        (max_snap_distance,)).fetchall()
+    if flagged:
+        logger.warning('{} points do not snap within {} meters for {}, e.g. {}'.format(len(flagged),
+            max_snap_distance, mode, ', '.join('{} {} ({})'.format(s, p, 'not snapped' if d is None else '{} m'.format(round(d)))
+            for s, p, d in flagged[:10])))
+    return flagged
+
+
+def ReadHints(db_fn, mode):
+    '''
+    Get the hints of the snapped points of a mode as ({orig_id : hint}, {dest_id : hint})
+    '''
+    db = sqlite3.connect(db_fn)
+    InitSnap(db, mode)
+    hints = {'orig' : {}, 'dest' : {}}
+    for source, point_id, hint in db.execute('SELECT source, point_id, hint FROM {}_snap WHERE hint IS NOT NULL'.format(mode)):
+        hints[source][point_id] = hint
+    db.close()
+    return hints['orig'], hints['dest']
+
+
+async def SnapAll(points, endpoints, mode, concurrency):
+    '''
+    Snap each (id, lon, lat) point, with concurrency requests in flight per endpoint.
+    Returns (hint, snap_lon, snap_lat, snap_distance) for each point.
+    '''
+    semaphore = asyncio.Semaphore(concurrency * len(endpoints))
+    timeout = aiohttp.ClientTimeout(total=failures.REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        return await asyncio.gather(*[SnapPoint(session, semaphore, endpoints[i % len(endpoints)], mode, point)
+            for i, point in enumerate(points)])
+
+
+async def SnapPoint(session, semaphore, endpoint, mode, point):
+    '''
+    Query /nearest for a point, retrying as failures.Retriable allows.
+    A point which cannot be snapped gets no hint.
+    '''
+    url = '{}/nearest/v1/{}/{},{}?number=1'.format(endpoint.rstrip('/'), mode, point[1], point[2])
+    for attempt in range(failures.MAX_ATTEMPTS):
+        try:
+            async with semaphore:
+                async with session.get(url) as r:
+                    response = await r.json(content_type=None)
+            if r.status == 200 and response.get('waypoints'):
+                waypoint = response['waypoints'][0]
+                return (waypoint['hint'], waypoint['location'][0], waypoint['location'][1], waypoint['distance'])
+            status = r.status
+            error = response.get('message', response.get('code'))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            status = None
+            error = repr(e)
+        if attempt == failures.MAX_ATTEMPTS - 1 or not failures.Retriable(status):
+            logger.warning('Could not snap {} ({}, {}): {}'.format(point[0], point[1], point[2], error))
+            return (None, None, None, None)
+        await asyncio.sleep(failures.Backoff(attempt))
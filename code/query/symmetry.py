@@ -0,0 +1,70 @@
+'''
+Check whether travel times can be taken as symmetric, so that only one direction of each
+pair of points is queried and the other is written by mirroring it (see database.WriteWorker).
+Walking is nearly symmetric, but one-way paths, turn restrictions and snapping can differ
+between directions, so a sample of pairs is queried both ways first.
+'''
+# our functions
+import failures
+from table_request import TableURL, ParseRows
+from tiling import OrigxDestTile
+# pip functions
+import requests
+import logging
+logger = logging.getLogger(__name__)
+
+# seconds two directions may differ by and still be taken as the same
+TOLERANCE = 30
+# share of the sampled pairs which may differ by more than the tolerance
+MAX_ASYMMETRIC = 0.01
+# origins sampled, each with up to SAMPLE_DESTS of its planned destinations
+SAMPLE_ORIGS = 20
+SAMPLE_DESTS = 100
+
+
+def CheckSymmetry(db, mode, endpoint, batcher, tolerance=TOLERANCE, max_asymmetric=MAX_ASYMMETRIC,
+        n_origs=SAMPLE_ORIGS, n_dests=SAMPLE_DESTS):
+    '''
+    Query a sample of the pairs in the plan_pairs view (see planner.PlanPairs) both ways
+    and return whether at most max_asymmetric of them differ by more than tolerance seconds
+    (or have a route one way only). A sample which cannot be queried is not symmetric.
+    '''
+    origs = db.execute('''SELECT orig_id, orig_lon, orig_lat FROM orig
+        WHERE orig_id IN (SELECT orig_id FROM plan_pairs WHERE orig_id < dest_id)
+        ORDER BY random() LIMIT ?''', (n_origs,)).fetchall()
+    n_pairs = 0
+    asymmetric = []
+    for orig in origs:
+        dests = db.execute('''SELECT dest_id, dest_lon, dest_lat FROM dest WHERE dest_id IN
+            (SELECT dest_id FROM plan_pairs WHERE orig_id = ? AND orig_id < dest_id) LIMIT ?''',
+            (orig[0], min(n_dests, batcher.Size()))).fetchall()
+        try:
+            there = QueryTimes(OrigxDestTile([orig], dests, None), endpoint, mode, batcher)
+            back = QueryTimes(OrigxDestTile(dests, [orig], None), endpoint, mode, batcher)
+        except requests.RequestException as e:
+            logger.warning('Could not check the symmetry of {} ({!r}): querying both ways'.format(mode, e))
+            return False
+        for (orig_id, dest_id), duration in there.items():
+            other = back[(dest_id, orig_id)]
+            if (duration is None) != (other is None) or (duration is not None and abs(duration - other) > tolerance):
+                asymmetric.append((orig_id, dest_id, duration, other))
+        n_pairs += len(there)
+
+    share = len(asymmetric) / n_pairs if n_pairs else 0
+    logger.info('{} of {} sampled {} pairs differ by more than {} seconds between directions, e.g. {}'.format(
+        len(asymmetric), n_pairs, mode, tolerance, asymmetric[:5]))
+    if share > max_asymmetric:
+        logger.warning('{} is not symmetric within {} seconds ({}% of the pairs): querying both ways'.format(
+            mode, tolerance, round(100 * share, 1)))
+        return False
+    return True
+
+
+def QueryTimes(pair, endpoint, mode, batcher):
+    '''
+    The durations of a batch as {(orig_id, dest_id) : duration}
+    '''
+    url = TableURL(pair, endpoint, mode, batcher.coords, hints=batcher.hints.get(mode))
+    r = requests.get(url, timeout=failures.REQUEST_TIMEOUT)
+    r.raise_for_status()
+    return {(row[0], row[1]) : row[2] for row in ParseRows(pair, r.json())}
@@ -0,0 +1,144 @@
+'''
+Build requests to the OSRM /table service and parse its responses
+'''
+import logging
+from urllib.parse import quote
+import numpy as np
+logger = logging.getLogger(__name__)
+
+# how the coordinates are sent: as text, or as a polyline with 5 or 6 decimal places
+COORDS = {'text' : None, 'polyline' : 5, 'polyline6' : 6}
+# characters per polyline coordinate, as estimated for the URL length (a local step is
+# 2 x 3-4 characters, plus the escaped ones); batching splits any request that is still too big
+POLYLINE_LENGTH = 16
+
+
+def TableURL(pair, endpoint, mode, coords='text', distances=False, hints=None):
+    '''
+    Form the /table request for a batch (OrigxMany or OrigxDestTile) to the OSRM server
+    at endpoint (e.g. http://localhost:5000).
+    The origins are listed first and used as the sources, the destinations follow.
+    coords is one of COORDS. With distances, the network distances are asked for too.
+    With hints ({orig_id : hint}, {dest_id : hint}), the server does not snap the
+    points again (a point without a hint is snapped as usual).
+    '''
+    base_query = '{}/table/v1/{}/'.format(endpoint, mode)
+    if coords == 'text':
+        mid_query = ';'.join(CoordText(lon, lat) for (loc_id, lon, lat) in pair.origs + pair.dests)
+    else:
+        mid_query = '{}({})'.format(coords, PolylineCoords(pair, COORDS[coords]))
+    n_origs = len(pair.origs)
+    end_query = '?sources={}&destinations={}'.format(
+        ';'.join(str(i) for i in range(n_origs)),
+        ';'.join(str(i) for i in range(n_origs, n_origs + len(pair.dests))))
+    if distances:
+        end_query += '&annotations=duration,distance'
+    if hints:
+        end_query += '&hints=' + ';'.join([hints[0].get(o[0], '') for o in pair.origs]
+            + [hints[1].get(d[0], '') for d in pair.dests])
+
+    return base_query + mid_query + end_query
+
+
+def CoordText(lon, lat):
+    return str(lon) + ',' + str(lat)
+
+
+def CoordLength(index, lon, lat, coords='text'):
+    '''
+    The characters a coordinate adds to the URL: the coordinate and its index in sources or destinations
+    '''
+    if coords == 'text':
+        return len(CoordText(lon, lat)) + len(str(index)) + 2
+    return POLYLINE_LENGTH + len(str(index)) + 1
+
+
+def PolylineCoords(pair, precision):
+    '''
+    The URL-escaped polyline of the origins and destinations of a batch.
+    Only the step to the first destination depends on the origins, so the rest of the
+    destinations are encoded once per batch and kept in pair.encoded (for retries).
+    '''
+    dests = pair.dests
+    if pair.encoded is None or pair.encoded[0] is not dests or pair.encoded[1] != precision:
+        tail = EncodePolyline([d[1] for d in dests[1:]], [d[2] for d in dests[1:]], precision,
+            start=(dests[0][1], dests[0][2]))
+        pair.encoded = (dests, precision, quote(tail, safe=''))
+    head_coords = pair.origs + dests[:1]
+    head = EncodePolyline([c[1] for c in head_coords], [c[2] for c in head_coords], precision)
+    return quote(head, safe='') + pair.encoded[2]
+
+
+def EncodePolyline(lon, lat, precision=5, start=None):
+    '''
+    Encode the coordinates as a polyline (the Google format OSRM reads, latitude first),
+    vectorized over the coordinates.
+    If start (lon, lat) is given, the first step is from there rather than from (0, 0).
+    '''
+    if len(lon) == 0:
+        return ''
+    factor = 10 ** precision
+    points = np.empty((len(lon) + 1, 2), dtype=np.int64)
+    points[0] = (0, 0) if start is None else np.round(np.array([start[1], start[0]]) * factor)
+    points[1:, 0] = np.round(np.asarray(lat, dtype=float) * factor)
+    points[1:, 1] = np.round(np.asarray(lon, dtype=float) * factor)
+    steps = np.diff(points, axis=0).ravel()
+
+    # zig-zag the signs into the lowest bit, then split into 5 bit chunks, lowest first
+    values = np.where(steps < 0, ~(steps << 1), steps << 1)
+    n_chunks = max(1, -(-int(values.max()).bit_length() // 5))
+    shifts = 5 * np.arange(n_chunks, dtype=np.int64)
+    chunks = (values[:, None] >> shifts) & 31
+    lengths = 1 + ((values[:, None] >> shifts[1:]) > 0).sum(axis=1)
+
+    # every chunk but the last of a value has the continuation bit (0x20) set
+    index = np.arange(n_chunks)
+    chars = chunks + 63 + 32 * (index < lengths[:, None] - 1)
+    return chars[index < lengths[:, None]].astype(np.uint8).tobytes().decode('ascii')
+
+
+def DecodePolyline(polyline, precision=5):
+    '''
+    The (lon, lat) coordinates of a polyline, as EncodePolyline encodes them
+    '''
+    coords = []
+    values = []
+    value = 0
+    shift = 0
+    for char in polyline.encode('ascii'):
+        chunk = char - 63
+        value |= (chunk & 31) << shift
+        shift += 5
+        if chunk < 32:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = 0
+            shift = 0
+    lat = lon = 0
+    for i in range(0, len(values) - 1, 2):
+        lat += values[i]
+        lon += values[i + 1]
+        coords.append((lon / 10 ** precision, lat / 10 ** precision))
+    return coords
+
+
+def ParseRows(pair, response):
+    '''
+    Unpack the JSON response from the server into (orig_id, dest_id, duration) rows,
+    or (orig_id, dest_id, duration, distance) rows if it has the distances.
+    The duration is None for a pair OSRM finds no route for (a null duration).
+    If the batch has a set of candidate pairs, only those are returned.
+    Any rows of the batch found in the cache are added.
+    '''
+    durations = response['durations']
+    distances = response.get('distances')
+
+    rows = []
+    for i, (orig_id, orig_lon, orig_lat) in enumerate(pair.origs):
+        res = durations[i]
+        for j, (dest_id, dest_lon, dest_lat) in enumerate(pair.dests):
+            if pair.pairs is None or (orig_id, dest_id) in pair.pairs:
+                row = [orig_id, dest_id, None if res[j] is None else int(res[j])]
+                if distances is not None:
+                    row.append(None if distances[i][j] is None else int(distances[i][j]))
+                rows.append(row)
+    return rows + pair.cached
@@ -0,0 +1,126 @@
+'''
+Plan many-to-many /table requests: spatially close origins are grouped together
+and share requests for the union of their candidate destinations.
+'''
+import logging
+import numpy as np
+logger = logging.getLogger(__name__)
+
+# bits per axis when ordering points along the Z-order (Morton) curve
+MORTON_BITS = 16
+
+
+def Tiles(db, n_sources, batcher):
+    '''
+    Generate OrigxDestTile batches of at most n_sources origins x as many destinations
+    as the batcher (batching.AdaptiveBatcher) allows, for the O-D pairs in the plan_pairs
+    view (see planner.PlanPairs).
+    Origins are grouped in Z-order so that each group is spatially compact; the
+    candidate destinations of a group are then split (also in Z-order) into tiles.
+    '''
+    cursor = db.cursor()
+
+    origs = cursor.execute('SELECT orig_id, orig_lon, orig_lat FROM orig').fetchall()
+    dests = {row[0] : row for row in cursor.execute('SELECT dest_id, dest_lon, dest_lat FROM dest')}
+    origs = [origs[i] for i in MortonOrder([o[1] for o in origs], [o[2] for o in origs])]
+
+    groups = [origs[i:i + n_sources] for i in range(0, len(origs), n_sources)]
+    logger.info('Planned {} origin groups of up to {} origins'.format(len(groups), n_sources))
+
+    # completion is reported at the last tile of every 5% of the origin groups
+    milestones = [(round(len(groups) * i / 20), round(i / 20 * 100)) for i in range(1, 20)]
+
+    for g, group in enumerate(groups):
+        query_str = '''SELECT orig_id, dest_id FROM plan_pairs
+            WHERE orig_id IN ({})'''.format(', '.join('?' * len(group)))
+        pairs = set(cursor.execute(query_str, [o[0] for o in group]))
+        if not pairs:
+            continue
+
+        dest_origs = {}
+        for orig_id, dest_id in pairs:
+            dest_origs.setdefault(dest_id, []).append(orig_id)
+
+        # sorted first, so the tiles (and their keys) are the same on every run
+        group_dests = [dests[dest_id] for dest_id in sorted(dest_origs)]
+        group_dests = [group_dests[i] for i in MortonOrder([d[1] for d in group_dests], [d[2] for d in group_dests])]
+
+        origs_length = sum(batcher.CoordLength(i, o[1], o[2]) for i, o in enumerate(group))
+        tile_dests = []
+        for dest in group_dests:
+            dest_length = batcher.CoordLength(len(group) + len(tile_dests), dest[1], dest[2])
+            if tile_dests and (len(tile_dests) >= size or not batcher.Fits(url_length + dest_length)):
+                yield OrigxDestTile(group, tile_dests, TilePairs(tile_dests, dest_origs))
+                tile_dests = []
+            if not tile_dests:
+                size = batcher.Size(len(group))
+                url_length = origs_length
+                dest_length = batcher.CoordLength(len(group), dest[1], dest[2])
+            tile_dests.append(dest)
+            url_length += dest_length
+        # the last tile of the group
+        yield OrigxDestTile(group, tile_dests, TilePairs(tile_dests, dest_origs), Completion(milestones, g + 1))
+
+
+def Completion(milestones, n_done):
+    '''
+    The percentage of the last milestone (a sorted list of (count, percentage)) passed by
+    n_done, if it was not reported yet
+    '''
+    completion = None
+    while milestones and milestones[0][0] <= n_done:
+        completion = milestones.pop(0)[1]
+    return completion
+
+
+def TilePairs(tile_dests, dest_origs):
+    '''
+    The candidate pairs of a tile, from the origins of each destination
+    '''
+    return set((orig_id, d[0]) for d in tile_dests for orig_id in dest_origs[d[0]])
+
+
+def MortonOrder(lon, lat):
+    '''
+    Return the indices that sort the points along the Z-order curve
+    '''
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    if len(lon) == 0:
+        return np.array([], dtype=int)
+    scale = 2 ** MORTON_BITS - 1
+    x = Quantize(lon, scale)
+    y = Quantize(lat, scale)
+
+    code = np.zeros(len(lon), dtype=np.uint64)
+    for b in range(MORTON_BITS):
+        code |= ((x >> b) & 1) << np.uint64(2 * b)
+        code |= ((y >> b) & 1) << np.uint64(2 * b + 1)
+    return np.argsort(code, kind='stable')
+
+
+def Quantize(values, scale):
+    '''
+    Scale the values onto the integers 0..scale
+    '''
+    span = values.max() - values.min()
+    if span == 0:
+        return np.zeros(len(values), dtype=np.uint64)
+    return np.round((values - values.min()) / span * scale).astype(np.uint64)
+
+
+class OrigxDestTile():
+    '''
+    Data structure containing the data for a single many-to-many query to the OSRM server.
+    Only the durations of the candidate pairs are kept from the returned matrix.
+    '''
+    def __init__(self, origs, dests, pairs, completion=None):
+        self.origs = origs
+        self.dests = dests
+        self.pairs = pairs
+        self.completion = completion
+        # rows found in the cache (see cache.TravelTimeCache)
+        self.cached = []
+        # the polyline of the destinations (see table_request.PolylineCoords)
+        self.encoded = None
+        self.key = '{}:{}'.format(origs[0][0], dests[0][0])
@@ -40,6 +40,7 @@ dem_fn = '../data/demographic/nhgis0002_ds172_2010_block.csv'
 db_fn = '../query_results/new_hssa/sea_5km.db' # this database will be generated
 copy_fn = '../query_results/new_hssa/sea_5km_after_hssa.db'
 max_dur = 30*60 # 30 minutes
+max_durs_for_sweep = [] # e.g. [10*60, 20*60, 30*60, 45*60], to compare the scores of several walksheds
 dem_field_for_hssa = ('pop_over_65', True)
 demographic_fields = [('pop_female','H76026'),('pop_below_10',True),('pop_color',True), ('pop_total','H76001') ]
 db_api_subset_name = '../query_results/new_hssa/sea_API.db'
@@ -65,7 +66,9 @@ add_demographics.main(dem_field_for_hssa, dem_fn, db_fn)
 
 # calculate the HSSA scores and funding allocation
 logger.info('calcHSSAscores...')
-calcHSSAscores.main(db_fn, dem_field_for_hssa[0], max_dur)
+calcHSSAscores.main(db_fn, dem_field_for_hssa[0], max_dur, engine='vectorized')
+if max_durs_for_sweep:
+    calcHSSAscores.sweep(db_fn, dem_field_for_hssa[0], max_durs_for_sweep)
 copyfile(db_fn, copy_fn)
 
 # add the rest of the demographics